@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable
+
+import numpy as np
+
+# Configured before the app is imported, everything reads its settings at import time
+os.environ.setdefault("SIGN_KEY", "benchmark")
+os.environ.setdefault("ADMIN_USERNAME", "admin")
+os.environ.setdefault("ADMIN_PASSWORD", "admin")
+if "DATABASE_URL" not in os.environ:
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='tracker-bench-'), 'bench.db')}"
+
+from fastapi.testclient import TestClient  # noqa: E402
+from sqlalchemy import insert  # noqa: E402
+from sqlmodel import Session, select  # noqa: E402
+
+import main  # noqa: E402
+from controller.auth import ACCESS_TOKEN_EXPIRE_MINUTES  # noqa: E402
+from controller.location import GEOHASH_PRECISION  # noqa: E402
+from database import engine  # noqa: E402
+from models import User, Role, Device, ApiKey, Location, LastLocation, MotionState  # noqa: E402
+from models.user import Scope, RoleScopeLink, UserRoleLink  # noqa: E402
+from utils.geo import geohash_encode  # noqa: E402
+from utils.passwords import pwd_context  # noqa: E402
+
+SEED_BATCH_SIZE = 50000
+
+
+def seed(run: str, users: int, roles: int, devices: int, locations: int, rng: np.random.Generator) -> dict:
+    with Session(engine) as session:
+        admin = session.exec(select(User).where(User.name == os.environ["ADMIN_USERNAME"])).one()
+        scope_ids = list(session.exec(select(Scope.id)).all())
+        # One hash for every seeded User, hashing each one would dominate the seeding time
+        password = pwd_context.hash("benchmark")
+        now = datetime.now()
+
+        user_rows = [{"id": uuid.uuid4(), "name": f"bench-user-{run}-{index}", "password": password, "created": now,
+                      "permission_version": 0} for index in range(users)]
+        role_rows = [{"id": uuid.uuid4(), "name": f"bench-role-{run}-{index}"} for index in range(roles)]
+        session.execute(insert(User), user_rows)
+        if role_rows:
+            session.execute(insert(Role), role_rows)
+            session.execute(insert(RoleScopeLink), [{"role_id": role["id"], "scope_id": scope_id}
+                                                    for role in role_rows
+                                                    for scope_id in rng.choice(scope_ids, size=min(5, len(scope_ids)),
+                                                                               replace=False).tolist()])
+            if user_rows:
+                session.execute(insert(UserRoleLink), [{"user_id": user["id"],
+                                                        "role_id": role_rows[int(rng.integers(len(role_rows)))]["id"]}
+                                                       for user in user_rows])
+
+        # The admin owns the Devices, so the location routes need no devices:others:* scopes
+        device_rows = [{"id": uuid.uuid4(), "name": f"bench-device-{run}-{index}", "description": "benchmark",
+                        "created": now, "owner_id": admin.id} for index in range(devices)]
+        session.execute(insert(Device), device_rows)
+        apikeys = [{"id": uuid.uuid4(), "apikey": uuid.uuid4().hex, "device_id": device["id"], "created": now}
+                   for device in device_rows]
+        session.execute(insert(ApiKey), apikeys)
+        session.commit()
+
+        # Random walks, one per Device, a point every 10 seconds ending now
+        per_device = locations // max(devices, 1)
+        start = now - timedelta(seconds=10 * per_device)
+        last_rows = []
+        for device in device_rows:
+            latitudes = np.clip(rng.uniform(-60, 60) + np.cumsum(rng.normal(0, 1e-4, per_device)), -90, 90)
+            longitudes = np.clip(rng.uniform(-170, 170) + np.cumsum(rng.normal(0, 1e-4, per_device)), -180, 180)
+            cells = geohash_encode(latitudes, longitudes, GEOHASH_PRECISION)
+            for offset in range(0, per_device, SEED_BATCH_SIZE):
+                session.execute(insert(Location), [
+                    {"id": uuid.uuid4(), "device_id": device["id"], "date": start + timedelta(seconds=10 * index),
+                     "latitude": float(latitudes[index]), "longitude": float(longitudes[index]),
+                     "cell": str(cells[index])}
+                    for index in range(offset, min(offset + SEED_BATCH_SIZE, per_device))])
+                session.commit()
+            if per_device:
+                last_rows.append({"device_id": device["id"], "date": start + timedelta(seconds=10 * (per_device - 1)),
+                                  "latitude": float(latitudes[-1]), "longitude": float(longitudes[-1])})
+
+        # What ingesting the walks would have derived, so ingestion and the latest positions start from steady state
+        if last_rows:
+            session.execute(insert(LastLocation), last_rows)
+            session.execute(insert(MotionState), [{**row, "anchor_date": row["date"],
+                                                   "anchor_latitude": row["latitude"],
+                                                   "anchor_longitude": row["longitude"]} for row in last_rows])
+            session.commit()
+
+    return {"users": user_rows, "devices": device_rows, "apikeys": [row["apikey"] for row in apikeys],
+            "locations_per_device": per_device}
+
+
+def measure(name: str, request: Callable[[int], object], count: int, warmup: int,
+            prepare: Callable[[], None]) -> dict:
+    for index in range(warmup):
+        prepare()
+        request(index)
+    latencies, errors = [], 0
+    elapsed = 0.0
+    for index in range(warmup, warmup + count):
+        # Untimed, e.g. renewing the access token
+        prepare()
+        before = time.perf_counter()
+        response = request(index)
+        latencies.append(time.perf_counter() - before)
+        elapsed += latencies[-1]
+        if not 200 <= response.status_code < 300:
+            errors += 1
+
+    milliseconds = np.array(latencies) * 1000
+    result = {"requests": count, "errors": errors, "throughput_rps": round(count / elapsed, 2),
+              "mean_ms": round(float(milliseconds.mean()), 3),
+              "p50_ms": round(float(np.percentile(milliseconds, 50)), 3),
+              "p99_ms": round(float(np.percentile(milliseconds, 99)), 3)}
+    print(f"{name:<24} {result['throughput_rps']:>10.1f} req/s  p50 {result['p50_ms']:>9.3f} ms  "
+          f"p99 {result['p99_ms']:>9.3f} ms  errors {errors}", file=sys.stderr)
+    return result
+
+
+def authenticate(client: TestClient, username: str, password: str) -> tuple[dict[str, str], Callable[[], None]]:
+    # The headers and a function renewing their token once half of its lifetime has passed, long runs would
+    # otherwise time 401 responses
+    headers: dict[str, str] = {}
+    renew_at = 0.0
+
+    def renew() -> None:
+        nonlocal renew_at
+        if time.monotonic() < renew_at:
+            return
+        response = client.post("/token", data={"username": username, "password": password})
+        response.raise_for_status()
+        headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        renew_at = time.monotonic() + float(ACCESS_TOKEN_EXPIRE_MINUTES) * 60 / 2
+
+    renew()
+    return headers, renew
+
+
+def benchmarks(run: str, client: TestClient, seeded: dict, rng: np.random.Generator,
+               headers: dict[str, str]) -> dict[str, Callable[[int], object]]:
+    username, password = os.environ["ADMIN_USERNAME"], os.environ["ADMIN_PASSWORD"]
+    users, devices, apikeys = seeded["users"], seeded["devices"], seeded["apikeys"]
+
+    def pick(rows: list, index: int):
+        return rows[index % len(rows)]
+
+    def points(index: int, count: int) -> list[dict]:
+        date = datetime.now() + timedelta(seconds=index)
+        return [{"date": (date + timedelta(milliseconds=offset)).isoformat(),
+                 "latitude": float(rng.uniform(-60, 60)), "longitude": float(rng.uniform(-170, 170))}
+                for offset in range(count)]
+
+    cases = {
+        "token": lambda index: client.post("/token", data={"username": username, "password": password}),
+        "users_list": lambda index: client.get("/users/?limit=100", headers=headers),
+        "roles_list": lambda index: client.get("/roles/?limit=100", headers=headers),
+        "devices_list": lambda index: client.get("/devices/?limit=100", headers=headers),
+        "device_create": lambda index: client.post(f"/devices/?name=bench-{run}-{index}&description=benchmark",
+                                                   headers=headers),
+        "locations_latest": lambda index: client.get("/devices/locations/latest", headers=headers),
+    }
+    if users:
+        cases["user_read"] = lambda index: client.get(f"/users/id/{pick(users, index)['id']}", headers=headers)
+    if devices:
+        cases["ingest_single"] = lambda index: client.post("/devices/locations", json=points(index, 1),
+                                                           headers={"X-API-Key": pick(apikeys, index)})
+        cases["ingest_batch_100"] = lambda index: client.post("/devices/locations", json=points(index, 100),
+                                                              headers={"X-API-Key": pick(apikeys, index)})
+        cases["history"] = lambda index: client.get(f"/devices/{pick(devices, index)['id']}/locations"
+                                                    f"?max_points=2000", headers=headers)
+    return cases
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: dict, baseline_path: str) -> None:
+    with open(baseline_path) as file:
+        baseline = json.load(file)["results"]
+    for name, result in results.items():
+        if name in baseline:
+            old = baseline[name]
+            print(f"{name:<24} throughput x{result['throughput_rps'] / old['throughput_rps']:.2f}  "
+                  f"p50 x{result['p50_ms'] / old['p50_ms']:.2f}  p99 x{result['p99_ms'] / old['p99_ms']:.2f}",
+                  file=sys.stderr)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Benchmarks the API hot paths in process. Uses DATABASE_URL if "
+                                                 "set, a fresh SQLite file otherwise. Seeded rows are left in the "
+                                                 "database, point it at a disposable one.")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--roles", type=int, default=50)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--locations", type=int, default=1000000, help="Total seeded Locations")
+    parser.add_argument("--requests", type=int, default=500, help="Measured requests per benchmark")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--only", nargs="*", help="Benchmarks to run, all by default")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark-results.json")
+    parser.add_argument("--compare", help="Earlier results file to print ratios against")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    # Names are unique per run, so the suite can be pointed at the same database repeatedly
+    run = uuid.uuid4().hex[:8]
+    # Server errors, like every other non-2xx response, are counted per benchmark instead of aborting the whole run
+    with TestClient(main.app, raise_server_exceptions=False) as client:
+        started = time.perf_counter()
+        seeded = seed(run, args.users, args.roles, args.devices, args.locations, rng)
+        print(f"Seeded in {time.perf_counter() - started:.1f}s", file=sys.stderr)
+        headers, renew = authenticate(client, os.environ["ADMIN_USERNAME"], os.environ["ADMIN_PASSWORD"])
+        results = {name: measure(name, request, args.requests, args.warmup, renew)
+                   for name, request in benchmarks(run, client, seeded, rng, headers).items()
+                   if not args.only or name in args.only}
+
+    report = {"meta": {"revision": git_revision(), "python": platform.python_version(),
+                       "platform": platform.platform(), "database": engine.dialect.name,
+                       "date": datetime.now().isoformat(timespec="seconds"),
+                       "parameters": {key: value for key, value in vars(args).items()
+                                      if key not in ("output", "compare")}},
+              "results": results}
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+        file.write("\n")
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1 +1 @@
-from .auth import auth_user, get_user, create_token, RoleValidator
\ No newline at end of file
+from .auth import auth_user, get_user, get_device, create_token, RoleValidator
\ No newline at end of file
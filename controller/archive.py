@@ -0,0 +1,176 @@
+import asyncio
+import fcntl
+import logging
+import os
+import shutil
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional, Iterator
+
+import numpy as np
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import delete
+from sqlmodel import Session, select
+
+from database import engine
+from models import Location, Device
+from models.device import to_naive_local
+from utils.segments import encode_segment, read_segment
+
+# Compaction and cold reads are disabled unless a directory for the segments is configured
+COLD_STORAGE_PATH = os.getenv("COLD_STORAGE_PATH")
+COMPACTION_AGE_DAYS = float(os.getenv("COMPACTION_AGE_DAYS", 90))
+# Seconds between compaction runs, 0 disables the job in this process. Runs of several workers sharing
+# COLD_STORAGE_PATH are exclusive, the others skip while one holds its lock file
+COMPACTION_INTERVAL = float(os.getenv("COMPACTION_INTERVAL", 3600))
+COMPACTION_BATCH_SIZE = int(os.getenv("COMPACTION_BATCH_SIZE", 100000))
+SEGMENT_SUFFIX = ".seg"
+COMPACTION_LOCK_NAME = ".compaction.lock"
+
+logger = logging.getLogger(__name__)
+
+
+def _device_path(device_id: uuid.UUID) -> str:
+    return os.path.join(COLD_STORAGE_PATH, str(device_id))
+
+
+def _segment_paths(device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime]) -> list[str]:
+    try:
+        names = sorted(name for name in os.listdir(_device_path(device_id)) if name.endswith(SEGMENT_SUFFIX))
+    except FileNotFoundError:
+        return []
+    # One segment per day, named after it, so the window is narrowed down by file name alone
+    first = str(np.datetime64(to_naive_local(start), "D")) if start else None
+    last = str(np.datetime64(to_naive_local(end), "D")) if end else None
+    return [os.path.join(_device_path(device_id), name) for name in names
+            if (first is None or name[:-len(SEGMENT_SUFFIX)] >= first)
+            and (last is None or name[:-len(SEGMENT_SUFFIX)] <= last)]
+
+
+def _read_window(path: str, start: Optional[datetime],
+                 end: Optional[datetime]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    ticks, latitudes, longitudes = read_segment(path)
+    dates = ticks.astype("datetime64[us]")
+    mask = np.ones(len(dates), dtype=bool)
+    if start:
+        mask &= dates >= np.datetime64(to_naive_local(start), "us")
+    if end:
+        mask &= dates < np.datetime64(to_naive_local(end), "us")
+    return dates[mask], latitudes[mask], longitudes[mask]
+
+
+def read_cold_track(device_id: uuid.UUID, start: Optional[datetime],
+                    end: Optional[datetime]) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    parts = [_read_window(path, start, end) for path in _segment_paths(device_id, start, end)] \
+        if COLD_STORAGE_PATH else []
+    if not parts:
+        return np.array([], dtype="datetime64[us]"), np.array([], dtype=np.float64), np.array([], dtype=np.float64)
+    dates, latitudes, longitudes = zip(*parts)
+    return np.concatenate(dates), np.concatenate(latitudes), np.concatenate(longitudes)
+
+
+def iter_cold_track(device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime]) -> Iterator[tuple]:
+    if not COLD_STORAGE_PATH:
+        return
+    # Decodes one day at a time, so exports of long tracks stay flat in memory
+    for path in _segment_paths(device_id, start, end):
+        dates, latitudes, longitudes = _read_window(path, start, end)
+        yield from zip(dates.tolist(), latitudes.tolist(), longitudes.tolist())
+
+
+def write_segment(device_id: uuid.UUID, day: np.datetime64, dates: np.ndarray, latitudes: np.ndarray,
+                  longitudes: np.ndarray) -> None:
+    os.makedirs(_device_path(device_id), exist_ok=True)
+    path = os.path.join(_device_path(device_id), f"{day}{SEGMENT_SUFFIX}")
+    ticks = dates.astype("datetime64[us]").astype(np.int64)
+    if os.path.exists(path):
+        # Late points of an already compacted day are merged into its segment
+        old_ticks, old_latitudes, old_longitudes = read_segment(path)
+        ticks = np.concatenate([old_ticks, ticks])
+        latitudes = np.concatenate([old_latitudes, latitudes])
+        longitudes = np.concatenate([old_longitudes, longitudes])
+
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "wb") as file:
+        file.write(encode_segment(ticks, latitudes, longitudes))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def compact_device(session: Session, device_id: uuid.UUID, cutoff: datetime) -> int:
+    moved = 0
+    while True:
+        rows = session.exec(select(Location.id, Location.date, Location.latitude, Location.longitude)
+                            .where(Location.device_id == device_id, Location.date < cutoff)
+                            .order_by(Location.date).limit(COMPACTION_BATCH_SIZE)).all()
+        if not rows:
+            return moved
+        ids, dates, latitudes, longitudes = zip(*rows)
+        dates = np.array(dates, dtype="datetime64[us]")
+        latitudes = np.array(latitudes, dtype=np.float64)
+        longitudes = np.array(longitudes, dtype=np.float64)
+        days = dates.astype("datetime64[D]")
+        bounds = np.flatnonzero(np.r_[True, days[1:] != days[:-1], True])
+        for first, last in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+            write_segment(device_id, days[first], dates[first:last], latitudes[first:last], longitudes[first:last])
+
+        # Rows are only deleted once their segments are on disk, a crash in between leaves duplicates that the
+        # next run drops while merging
+        for offset in range(0, len(ids), 1000):
+            session.execute(delete(Location).where(Location.id.in_(ids[offset:offset + 1000])))
+        session.commit()
+        moved += len(ids)
+
+
+def drop_segments(device_id: uuid.UUID) -> None:
+    if COLD_STORAGE_PATH:
+        shutil.rmtree(_device_path(device_id), ignore_errors=True)
+
+
+def compact_locations(cutoff: Optional[datetime] = None) -> int:
+    os.makedirs(COLD_STORAGE_PATH, exist_ok=True)
+    with open(os.path.join(COLD_STORAGE_PATH, COMPACTION_LOCK_NAME), "a") as lock:
+        # Segments are merged and replaced, then their rows deleted, so two processes compacting the same day could
+        # overwrite each other's segment after its rows are gone. A POSIX record lock, released if the process dies
+        try:
+            fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            logger.info("Location compaction skipped, another process is running it")
+            return 0
+        try:
+            return _compact_locations(cutoff)
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def _compact_locations(cutoff: Optional[datetime]) -> int:
+    cutoff = cutoff or to_naive_local(datetime.now().astimezone()) - timedelta(days=COMPACTION_AGE_DAYS)
+    moved = 0
+    with Session(engine) as session:
+        device_ids = set(session.exec(select(Device.id)).all())
+        # Devices are visited one by one so every query is a range scan on the (device_id, date) index
+        for device_id in device_ids:
+            moved += compact_device(session, device_id, cutoff)
+
+    # Segments of Devices deleted along with their owner
+    if os.path.isdir(COLD_STORAGE_PATH):
+        for name in os.listdir(COLD_STORAGE_PATH):
+            try:
+                orphaned = uuid.UUID(name) not in device_ids
+            except ValueError:
+                continue
+            if orphaned:
+                shutil.rmtree(os.path.join(COLD_STORAGE_PATH, name), ignore_errors=True)
+    return moved
+
+
+async def compaction_loop() -> None:
+    while True:
+        await asyncio.sleep(COMPACTION_INTERVAL)
+        try:
+            moved = await run_in_threadpool(compact_locations)
+            if moved:
+                logger.info("Moved %d locations to cold storage", moved)
+        except Exception:
+            logger.exception("Location compaction failed")
@@ -5,16 +5,21 @@ from functools import wraps
 from typing import Annotated, Optional
 
 from fastapi import HTTPException, status, Depends
-from fastapi.security import OAuth2PasswordBearer
+from fastapi.concurrency import run_in_threadpool
+from fastapi.security import OAuth2PasswordBearer, APIKeyHeader
 from jose import jwt, JWTError
-from passlib.context import CryptContext
-from sqlmodel import Session
+from sqlalchemy import update, event, Update
+from sqlalchemy.orm import selectinload
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing_extensions import override
 
-from deps import get_session
-from models import UserLogin, User, Token
+from deps import get_session, get_async_session
+from models import UserLogin, User, Token, TokenClaims, Device, ApiKey, DeviceIdentity, Role
+from utils.cache import TTLCache
 from utils.crud import GenericCRUD
 from utils.models import ObjectIdentifier
+from utils.passwords import verify_password
 
 SIGN_ALGORITHM = "HS256"
 SIGN_KEY = os.getenv("SIGN_KEY")
@@ -23,19 +28,35 @@ if SIGN_KEY is None:
 
 ACCESS_TOKEN_EXPIRE_MINUTES = os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", 5)
 REFRESH_TOKEN_EXPIRE_MINUTES = os.getenv("REFRESH_TOKEN_EXPIRE_MINUTES", 10)
+APIKEY_CACHE_SIZE = int(os.getenv("APIKEY_CACHE_SIZE", 10000))
+# Rotating or deleting a key evicts it on the worker that did it, other workers keep accepting the old key until
+# their cached entry expires, i.e. for up to APIKEY_CACHE_TTL seconds
+APIKEY_CACHE_TTL = float(os.getenv("APIKEY_CACHE_TTL", 10))
+STATELESS_AUTH = os.getenv("STATELESS_AUTH", "false").lower() in ("1", "true", "yes")
+PERMISSION_VERSION_CACHE_SIZE = int(os.getenv("PERMISSION_VERSION_CACHE_SIZE", 10000))
+# With STATELESS_AUTH, other workers keep accepting tokens revoked by a role change or user deletion until their
+# cached version expires, i.e. for up to PERMISSION_VERSION_TTL seconds. The worker that revoked rejects them at once
+PERMISSION_VERSION_TTL = float(os.getenv("PERMISSION_VERSION_TTL", 30))
 
 oauth_scheme = OAuth2PasswordBearer(tokenUrl="token")
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+apikey_scheme = APIKeyHeader(name="X-API-Key")
+apikey_cache: TTLCache[str, DeviceIdentity] = TTLCache(maxsize=APIKEY_CACHE_SIZE, ttl=APIKEY_CACHE_TTL)
+permission_versions: TTLCache[uuid.UUID, int] = TTLCache(maxsize=PERMISSION_VERSION_CACHE_SIZE,
+                                                        ttl=PERMISSION_VERSION_TTL)
 
-def auth_user(user_login: UserLogin, db: Session) -> User:
+async def auth_user(user_login: UserLogin, db: Session) -> User:
     crud = GenericCRUD(db)
-    user: Optional[User] = crud.read_raw(User, name___is=user_login.name)
-
-    if user and pwd_context.verify(user_login.password, user.password):
-        return user
-
+    user: Optional[User] = await run_in_threadpool(crud.read_raw, User, name___is=user_login.name)
     if not user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+
+    valid, new_hash = await verify_password(user_login.password, user.password)
+    if not valid:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
+    if new_hash:
+        # The stored hash was created with outdated CryptContext parameters
+        user.password = new_hash
+        await run_in_threadpool(crud.refresh, user)
     return user
 
 
@@ -49,6 +70,7 @@ def create_token(user: User) -> Token:
         "name": user.name,
         "roles": [role.name for role in user.roles],
         "scopes": [scope.name for role in user.roles for scope in role.scopes],
+        "pv": user.permission_version,
     }
 
     now = datetime.now(timezone.utc)
@@ -62,22 +84,151 @@ def create_token(user: User) -> Token:
     return Token(access_token=access_token, refresh_token=refresh_token, token_type="bearer")
 
 
-def get_user(token: Annotated[str, Depends(oauth_scheme)], db: Annotated[Session, Depends(get_session)]) -> User:
-    auth_exception = HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+def decode_token(token: str) -> TokenClaims:
     try:
-        payload = jwt.decode(token, SIGN_KEY, algorithms=[SIGN_ALGORITHM])
-        user_id: uuid.UUID = uuid.UUID(payload.get("sub"))
-        if user_id is None:
-            raise auth_exception
-    except JWTError:
-        raise auth_exception
+        return TokenClaims.model_validate(jwt.decode(token, SIGN_KEY, algorithms=[SIGN_ALGORITHM]))
+    except (JWTError, ValueError):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+
+
+def get_user(token: Annotated[str, Depends(oauth_scheme)], db: Annotated[Session, Depends(get_session)]) -> User:
+    claims = decode_token(token)
     crud = GenericCRUD(db)
-    user: Optional[User] = crud.read(User, ObjectIdentifier(id=user_id))
+    user: Optional[User] = crud.read(User, ObjectIdentifier(id=claims.sub))
     if not user:
-        raise auth_exception
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
     return user
 
 
+async def get_async_user(token: Annotated[str, Depends(oauth_scheme)],
+                         db: Annotated[AsyncSession, Depends(get_async_session)]) -> User:
+    # For the routers on the async engine, so a request does not hold a connection of each engine. The scopes are
+    # loaded up front, they cannot be lazy loaded outside the greenlet
+    claims = decode_token(token)
+    sel = select(User).where(User.id == claims.sub).options(selectinload(User.roles).selectinload(Role.scopes))
+    user: Optional[User] = (await db.exec(sel)).first()
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    return user
+
+
+def _cache_version(claims: TokenClaims, version: Optional[int]) -> int:
+    if version is None:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Could not validate credentials")
+    permission_versions.set(claims.sub, version)
+    return version
+
+
+def _check_version(claims: TokenClaims, version: int) -> TokenClaims:
+    if claims.pv < version:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Token permissions are outdated")
+    return claims
+
+
+def get_claims(token: Annotated[str, Depends(oauth_scheme)],
+               db: Annotated[Session, Depends(get_session)]) -> TokenClaims:
+    claims = decode_token(token)
+    version = permission_versions.get(claims.sub)
+    if version is None:
+        sel = select(User.permission_version).where(User.id == claims.sub)
+        version = _cache_version(claims, db.exec(sel).first())
+    return _check_version(claims, version)
+
+
+async def get_async_claims(token: Annotated[str, Depends(oauth_scheme)],
+                           db: Annotated[AsyncSession, Depends(get_async_session)]) -> TokenClaims:
+    claims = decode_token(token)
+    version = permission_versions.get(claims.sub)
+    if version is None:
+        sel = select(User.permission_version).where(User.id == claims.sub)
+        version = _cache_version(claims, (await db.exec(sel)).first())
+    return _check_version(claims, version)
+
+
+def _bump_versions(criteria) -> Update:
+    return update(User).where(*criteria).values(permission_version=User.permission_version + 1)
+
+
+def _forget_versions_on_commit(db: Session) -> None:
+    # Not before, a concurrent request could cache the old version again while the bump is uncommitted
+    event.listen(db, "after_commit", lambda _: permission_versions.clear(), once=True)
+
+
+def revoke_permissions(db: Session, *criteria) -> None:
+    # Tokens issued before the bump are rejected by get_claims, see PERMISSION_VERSION_TTL for other workers
+    db.execute(_bump_versions(criteria))
+    _forget_versions_on_commit(db)
+
+
+async def async_revoke_permissions(db: AsyncSession, *criteria) -> None:
+    await db.execute(_bump_versions(criteria))
+    _forget_versions_on_commit(db.sync_session)
+
+
+def user_scopes(user: User) -> set[str]:
+    return {scope.name for role in user.roles for scope in role.scopes}
+
+
+def _scopes_from_user(user: Annotated[User, Depends(get_user)]) -> set[str]:
+    return user_scopes(user)
+
+
+def _scopes_from_claims(claims: Annotated[TokenClaims, Depends(get_claims)]) -> set[str]:
+    return set(claims.scopes)
+
+
+async def _scopes_from_async_user(user: Annotated[User, Depends(get_async_user)]) -> set[str]:
+    return user_scopes(user)
+
+
+async def _scopes_from_async_claims(claims: Annotated[TokenClaims, Depends(get_async_claims)]) -> set[str]:
+    return set(claims.scopes)
+
+
+def _id_from_user(user: Annotated[User, Depends(get_user)]) -> uuid.UUID:
+    return user.id
+
+
+def _id_from_claims(claims: Annotated[TokenClaims, Depends(get_claims)]) -> uuid.UUID:
+    return claims.sub
+
+
+get_scopes = _scopes_from_claims if STATELESS_AUTH else _scopes_from_user
+get_async_scopes = _scopes_from_async_claims if STATELESS_AUTH else _scopes_from_async_user
+# For routes that only need to know who is authenticated, with STATELESS_AUTH without loading the User
+get_user_id = _id_from_claims if STATELESS_AUTH else _id_from_user
+
+
+def get_token_scopes(token: str, db: Session) -> tuple[uuid.UUID, set[str]]:
+    # For connections that cannot go through the OAuth2 header dependencies, e.g. WebSockets
+    if STATELESS_AUTH:
+        claims = get_claims(token, db)
+        return claims.sub, set(claims.scopes)
+    user = get_user(token, db)
+    return user.id, user_scopes(user)
+
+
+def get_device(apikey: Annotated[str, Depends(apikey_scheme)],
+               db: Annotated[Session, Depends(get_session)]) -> DeviceIdentity:
+    identity = apikey_cache.get(apikey)
+    if identity:
+        return identity
+    row = db.exec(select(Device.id, Device.owner_id).join(ApiKey).where(ApiKey.apikey == apikey)).first()
+    if not row:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid api key")
+    identity = DeviceIdentity(device_id=row[0], owner_id=row[1])
+    apikey_cache.set(apikey, identity)
+    return identity
+
+
+def evict_device_apikeys(device_id: uuid.UUID) -> None:
+    apikey_cache.evict_where(lambda _, identity: identity.device_id == device_id)
+
+
+def evict_owner_apikeys(owner_id: uuid.UUID) -> None:
+    apikey_cache.evict_where(lambda _, identity: identity.owner_id == owner_id)
+
+
 class RoleValidator:
     def __init__(self, allowed_roles: list[str]):
         self.allowed_roles = allowed_roles
@@ -95,31 +246,37 @@ class ScopeValidator:
         self.needed_scope = needed_scope
         self.registered_scopes.add(self.needed_scope)
 
-    def __call__(self, user: Annotated[User, Depends(get_user)]):
-        user_scopes = {scope.name for role in user.roles for scope in role.scopes}
-        if self.needed_scope in user_scopes:
+    def __call__(self, scopes: Annotated[set[str], Depends(get_scopes)]):
+        if self.needed_scope in scopes:
             return True
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=f'Missing scope {self.needed_scope}')
 
 
+class AsyncScopeValidator(ScopeValidator):
+
+    @override
+    async def __call__(self, scopes: Annotated[set[str], Depends(get_async_scopes)]):
+        return super().__call__(scopes)
+
+
 class ImplicitScopeValidator(ScopeValidator):
-    def __init__(self, needed_scope: str):
+    def __init__(self, needed_scope: str, scopes: Optional[set[str]] = None):
         super().__init__(needed_scope)
+        self.scopes = scopes
 
     @override
-    def __call__(self, user: Annotated[User, Depends(get_user)]):
-        return self
-
-    def validate(self, user: User):
-        super().__call__(user)
+    def __call__(self, scopes: Annotated[set[str], Depends(get_scopes)]):
+        return ImplicitScopeValidator(self.needed_scope, scopes)
 
+    def validate(self, user: Optional[User] = None):
+        super().__call__(self.scopes if self.scopes is not None else user_scopes(user))
 
 
 def scope(needed_scope: str):
     def decorator(func):
         @wraps(func)
         async def wrapper(*args, user: Depends(get_user), **kwargs):
-            ScopeValidator(needed_scope)(user)
+            ScopeValidator(needed_scope)(user_scopes(user))
             return await func(*args, **kwargs)
 
         return wrapper
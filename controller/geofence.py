@@ -0,0 +1,132 @@
+import os
+import uuid
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import delete
+from sqlmodel import Session, select
+
+from models import Geofence, GeofencePresence, GeofenceEvent, LocationBase
+from models.geofence import GeofenceGeometry
+from utils.cache import TTLCache
+from utils.crud import GenericCRUD
+from utils.geo import radius_bounds, haversine, points_in_polygon
+
+GEOFENCE_CACHE_SIZE = int(os.getenv("GEOFENCE_CACHE_SIZE", 10000))
+GEOFENCE_CACHE_TTL = float(os.getenv("GEOFENCE_CACHE_TTL", 60))
+
+
+def geofence_bounds(geometry: GeofenceGeometry) -> dict:
+    if geometry.kind == "circle":
+        if geometry.latitude is None or geometry.longitude is None or not geometry.radius:
+            raise ValueError("A circle needs latitude, longitude and radius")
+        min_lat, min_lon, max_lat, max_lon = radius_bounds(geometry.latitude, geometry.longitude, geometry.radius)
+    else:
+        vertices = np.array(geometry.vertices or [], dtype=np.float64)
+        if vertices.ndim != 2 or vertices.shape[0] < 3 or vertices.shape[1] != 2:
+            raise ValueError("A polygon needs at least three [latitude, longitude] vertices")
+        if np.any(np.abs(vertices[:, 0]) > 90) or np.any(np.abs(vertices[:, 1]) > 180):
+            raise ValueError("Polygon vertices are out of range")
+        (min_lat, min_lon), (max_lat, max_lon) = vertices.min(axis=0), vertices.max(axis=0)
+    return {"min_latitude": float(min_lat), "min_longitude": float(min_lon),
+            "max_latitude": float(max_lat), "max_longitude": float(max_lon)}
+
+
+@dataclass
+class FenceIndex:
+    ids: np.ndarray
+    device_ids: np.ndarray
+    bounds: np.ndarray
+    circles: dict[int, tuple[float, float, float]]
+    polygons: dict[int, np.ndarray]
+
+    @classmethod
+    def build(cls, fences: list[Geofence]) -> "FenceIndex":
+        circles, polygons = {}, {}
+        for position, fence in enumerate(fences):
+            if fence.kind == "circle":
+                circles[position] = (fence.latitude, fence.longitude, fence.radius)
+            else:
+                polygons[position] = np.array(fence.vertices, dtype=np.float64)
+        bounds = np.array([(fence.min_latitude, fence.min_longitude, fence.max_latitude, fence.max_longitude)
+                           for fence in fences], dtype=np.float64).reshape(-1, 4)
+        return cls(ids=np.array([fence.id for fence in fences], dtype=object),
+                   device_ids=np.array([fence.device_id for fence in fences], dtype=object),
+                   bounds=bounds, circles=circles, polygons=polygons)
+
+    def contains(self, position: int, latitudes: np.ndarray, longitudes: np.ndarray) -> np.ndarray:
+        if position in self.circles:
+            latitude, longitude, radius = self.circles[position]
+            return haversine(latitudes, longitudes, latitude, longitude) <= radius
+        return points_in_polygon(latitudes, longitudes, self.polygons[position])
+
+
+# Fences of one owner, rebuilt lazily after the geofence routes invalidate them
+fence_indexes: TTLCache[uuid.UUID, FenceIndex] = TTLCache(maxsize=GEOFENCE_CACHE_SIZE, ttl=GEOFENCE_CACHE_TTL)
+
+
+def invalidate_fences(owner_id: uuid.UUID) -> None:
+    fence_indexes.evict(owner_id)
+
+
+def _fence_index(session: Session, owner_id: uuid.UUID) -> FenceIndex:
+    index = fence_indexes.get(owner_id)
+    if index is None:
+        index = FenceIndex.build(list(session.exec(select(Geofence).where(Geofence.owner_id == owner_id)).all()))
+        fence_indexes.set(owner_id, index)
+    return index
+
+
+def evaluate_geofences(crud: GenericCRUD, device_id: uuid.UUID, owner_id: uuid.UUID,
+                       points: list[LocationBase]) -> list[dict]:
+    session = crud.session
+    index = _fence_index(session, owner_id)
+    if not points or not len(index.ids):
+        return []
+
+    points = sorted(points, key=lambda point: point.date)
+    latitudes = np.fromiter((point.latitude for point in points), dtype=np.float64, count=len(points))
+    longitudes = np.fromiter((point.longitude for point in points), dtype=np.float64, count=len(points))
+
+    relevant = np.array([fence_device is None or fence_device == device_id for fence_device in index.device_ids])
+    bounds = index.bounds
+    # Points x fences bounding box test, only the surviving pairs get the exact geometry test
+    candidates = ((latitudes[:, None] >= bounds[None, :, 0]) & (latitudes[:, None] <= bounds[None, :, 2])
+                  & (longitudes[:, None] >= bounds[None, :, 1]) & (longitudes[:, None] <= bounds[None, :, 3]))
+    candidates &= relevant[None, :]
+
+    present = set(session.exec(select(GeofencePresence.geofence_id)
+                               .where(GeofencePresence.device_id == device_id)).all())
+    positions = np.flatnonzero(candidates.any(axis=0)
+                               | np.array([fence_id in present for fence_id in index.ids], dtype=bool))
+
+    events, entered, exited = [], [], []
+    for position in positions.tolist():
+        fence_id = index.ids[position]
+        inside = np.zeros(len(points), dtype=bool)
+        rows = np.flatnonzero(candidates[:, position])
+        if len(rows):
+            inside[rows] = index.contains(position, latitudes[rows], longitudes[rows])
+
+        states = np.r_[fence_id in present, inside]
+        for row in np.flatnonzero(states[1:] != states[:-1]).tolist():
+            events.append({"id": uuid.uuid4(), "geofence_id": fence_id, "device_id": device_id,
+                           "kind": "enter" if inside[row] else "exit", "date": points[row].date,
+                           "latitude": points[row].latitude, "longitude": points[row].longitude})
+        if states[-1] != states[0]:
+            if states[-1]:
+                entered.append({"geofence_id": fence_id, "device_id": device_id, "since": events[-1]["date"]})
+            else:
+                exited.append(fence_id)
+
+    if exited:
+        session.execute(delete(GeofencePresence).where(GeofencePresence.device_id == device_id,
+                                                       GeofencePresence.geofence_id.in_(exited)))
+    crud.create_many(GeofencePresence, entered)
+    crud.create_many(GeofenceEvent, events)
+    return events
+
+
+def geofence_owner(crud: GenericCRUD, geofence_id: uuid.UUID) -> Optional[uuid.UUID]:
+    return crud.session.exec(select(Geofence.owner_id).where(Geofence.id == geofence_id)).first()
@@ -0,0 +1,203 @@
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from functools import partial
+from typing import Optional
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel import Session
+
+from controller.location import write_locations
+from database import engine
+from models import LocationBase, DeviceIdentity
+from utils.crud import GenericCRUD
+from utils.metrics import registry, Counter, Gauge, Histogram
+
+# A flush starts once INGEST_BATCH_SIZE points are buffered or the oldest one waited INGEST_FLUSH_INTERVAL
+# milliseconds, 0 disables the buffer and every request commits on its own
+INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", 1000))
+INGEST_FLUSH_INTERVAL = float(os.getenv("INGEST_FLUSH_INTERVAL", 50)) / 1000
+# Buffered points above which requests are turned away with a 503 until the database catches up
+INGEST_MAX_BUFFERED = int(os.getenv("INGEST_MAX_BUFFERED", 50000))
+# Respond as soon as the points are buffered instead of once they are committed. Faster, but points still in the
+# buffer are lost if the process dies without shutting down
+INGEST_WRITE_BEHIND = os.getenv("INGEST_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+INGEST_RETRY_AFTER = 1
+
+BATCH_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+logger = logging.getLogger(__name__)
+
+ingest_buffered = registry.register(Gauge("ingest_buffered_points", "Points waiting in the ingest buffer"))
+ingest_rejected = registry.register(Counter("ingest_rejected_total", "Ingest requests rejected as the buffer was full"))
+ingest_batch_points = registry.register(Histogram("ingest_flush_points", "Points committed per ingest flush",
+                                                  buckets=BATCH_BUCKETS))
+ingest_batch_requests = registry.register(Histogram("ingest_flush_requests", "Requests coalesced per ingest flush",
+                                                    buckets=BATCH_BUCKETS))
+ingest_flush_duration = registry.register(Histogram("ingest_flush_duration_seconds", "Latency of an ingest flush"))
+ingest_flush_failures = registry.register(Counter("ingest_flush_failures_total",
+                                                  "Ingest flushes that had to be retried request by request"))
+
+
+@dataclass
+class PendingWrite:
+    device: DeviceIdentity
+    points: list[LocationBase]
+    arrived: float
+    # Resolved once committed, None when nobody waits for it
+    future: Optional[asyncio.Future]
+
+
+def _write(batch: list[PendingWrite]) -> list[Optional[Exception]]:
+    with Session(engine) as session:
+        crud = GenericCRUD(session)
+        try:
+            write_locations(crud, [(pending.device, pending.points) for pending in batch])
+            return [None] * len(batch)
+        except Exception:
+            if len(batch) == 1:
+                raise
+            ingest_flush_failures.inc()
+            logger.warning("Ingest flush of %d requests failed, retrying them one by one", len(batch), exc_info=True)
+
+        # Keeps a single bad request, e.g. of a Device deleted in the meantime, from failing the others
+        errors: list[Optional[Exception]] = []
+        for pending in batch:
+            try:
+                write_locations(crud, [(pending.device, pending.points)])
+                errors.append(None)
+            except Exception as e:
+                errors.append(e)
+        return errors
+
+
+def _log_dropped(device: DeviceIdentity, count: int, error: BaseException) -> None:
+    logger.error("Dropped %d Locations of Device %s", count, device.device_id, exc_info=error)
+
+
+def _log_abandoned(device: DeviceIdentity, count: int, future: asyncio.Future) -> None:
+    # Retrieves the error of a write whose request was cancelled, nothing else would
+    if not future.cancelled() and future.exception() is not None:
+        _log_dropped(device, count, future.exception())
+
+
+class IngestBuffer:
+    # Coalesces the Location batches of all Devices, so thousands of trackers sending single points cost a commit
+    # per flush instead of one per request. Flushes run one after another on their own connection
+
+    def __init__(self, batch_size: int, flush_interval: float, max_buffered: int, write_behind: bool):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.write_behind = write_behind
+        self._pending: list[PendingWrite] = []
+        self._buffered = 0
+        self._arrived: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._closing
+
+    def start(self) -> None:
+        # Created here, as they belong to the running event loop
+        self._arrived, self._full = asyncio.Event(), asyncio.Event()
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        # Stops taking new points and waits for the buffered ones to be committed
+        if self._task is None:
+            return
+        self._closing = True
+        self._arrived.set()
+        self._full.set()
+        await self._task
+        self._task = None
+
+    async def submit(self, device: DeviceIdentity, points: list[LocationBase]) -> None:
+        if not points:
+            return
+        # A batch larger than the whole buffer is still taken while nothing else is waiting
+        if self._buffered and self._buffered + len(points) > self.max_buffered:
+            ingest_rejected.inc()
+            raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                detail="Too many Locations waiting to be stored, retry later",
+                                headers={"Retry-After": str(INGEST_RETRY_AFTER)})
+
+        loop = asyncio.get_running_loop()
+        future = None if self.write_behind else loop.create_future()
+        self._pending.append(PendingWrite(device, points, loop.time(), future))
+        self._buffered += len(points)
+        ingest_buffered.inc(amount=len(points))
+        self._arrived.set()
+        if self._buffered >= self.batch_size:
+            self._full.set()
+        if future is not None:
+            # Shielded, a client hanging up must not cancel the write of points that are already buffered
+            try:
+                await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # Nobody awaits the write anymore, report its failure here instead
+                future.add_done_callback(partial(_log_abandoned, device, len(points)))
+                raise
+
+    def _take(self) -> list[PendingWrite]:
+        count, taken = 0, 0
+        while count < len(self._pending) and (not count or taken + len(self._pending[count].points) <= self.batch_size):
+            taken += len(self._pending[count].points)
+            count += 1
+        batch, self._pending = self._pending[:count], self._pending[count:]
+        self._buffered -= taken
+        ingest_buffered.dec(amount=taken)
+        if not self._pending and not self._closing:
+            self._arrived.clear()
+        if self._buffered < self.batch_size and not self._closing:
+            self._full.clear()
+        return batch
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._arrived.wait()
+            if not self._pending:
+                # Only woken up to shut down
+                return
+            timeout = self._pending[0].arrived + self.flush_interval - loop.time()
+            if timeout > 0 and not self._full.is_set():
+                try:
+                    await asyncio.wait_for(self._full.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            await self._flush(self._take())
+
+    async def _flush(self, batch: list[PendingWrite]) -> None:
+        started = time.perf_counter()
+        try:
+            errors = await run_in_threadpool(_write, batch)
+        except Exception as e:
+            # Every request of the batch failed with it, not just the first
+            errors = [e] * len(batch)
+        finally:
+            ingest_flush_duration.observe(time.perf_counter() - started)
+        ingest_batch_points.observe(sum(len(pending.points) for pending in batch))
+        ingest_batch_requests.observe(len(batch))
+
+        for pending, error in zip(batch, errors):
+            if pending.future is None:
+                if error is not None:
+                    _log_dropped(pending.device, len(pending.points), error)
+            elif pending.future.done():
+                continue
+            elif error is not None:
+                pending.future.set_exception(error)
+            else:
+                pending.future.set_result(None)
+
+
+ingest_buffer = IngestBuffer(INGEST_BATCH_SIZE, INGEST_FLUSH_INTERVAL, INGEST_MAX_BUFFERED, INGEST_WRITE_BEHIND)
@@ -0,0 +1,95 @@
+import asyncio
+import json
+import os
+import threading
+import uuid
+from contextlib import contextmanager
+from typing import Iterator, Optional, AsyncIterator
+
+from models import LocationBase
+
+LIVE_QUEUE_SIZE = int(os.getenv("LIVE_QUEUE_SIZE", 256))
+LIVE_KEEPALIVE = float(os.getenv("LIVE_KEEPALIVE", 15))
+
+
+class Subscription:
+
+    def __init__(self, device_ids: set[uuid.UUID], maxsize: int):
+        self.device_ids = device_ids
+        self.queue: asyncio.Queue[str] = asyncio.Queue(maxsize=maxsize)
+        self.dropped = 0
+
+    def offer(self, message: str) -> None:
+        # Slow consumers lose their oldest messages instead of stalling the publisher or growing without bound
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def get(self) -> str:
+        return await self.queue.get()
+
+
+class LocationHub:
+
+    def __init__(self, queue_size: int = LIVE_QUEUE_SIZE):
+        self.queue_size = queue_size
+        self._subscriptions: dict[uuid.UUID, set[Subscription]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def subscribe(self, device_ids: set[uuid.UUID]) -> Iterator[Subscription]:
+        self._loop = asyncio.get_running_loop()
+        subscription = Subscription(device_ids, self.queue_size)
+        with self._lock:
+            for device_id in device_ids:
+                self._subscriptions.setdefault(device_id, set()).add(subscription)
+        try:
+            yield subscription
+        finally:
+            with self._lock:
+                for device_id in device_ids:
+                    subscribers = self._subscriptions.get(device_id)
+                    if subscribers is not None:
+                        subscribers.discard(subscription)
+                        if not subscribers:
+                            del self._subscriptions[device_id]
+
+    def publish(self, device_id: uuid.UUID, points: list[LocationBase]) -> None:
+        if device_id not in self._subscriptions or self._loop is None or self._loop.is_closed():
+            return
+        # Encoded once, no matter how many subscribers receive it
+        messages = [json.dumps({"device_id": str(device_id), "date": point.date.isoformat(),
+                                "latitude": point.latitude, "longitude": point.longitude})
+                    for point in sorted(points, key=lambda point: point.date)]
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._dispatch(device_id, messages)
+        else:
+            self._loop.call_soon_threadsafe(self._dispatch, device_id, messages)
+
+    def _dispatch(self, device_id: uuid.UUID, messages: list[str]) -> None:
+        with self._lock:
+            subscribers = list(self._subscriptions.get(device_id, ()))
+        for subscription in subscribers:
+            for message in messages:
+                subscription.offer(message)
+
+
+location_hub = LocationHub()
+
+
+async def event_stream(device_ids: set[uuid.UUID]) -> AsyncIterator[str]:
+    with location_hub.subscribe(device_ids) as subscription:
+        yield ": connected\n\n"
+        while True:
+            try:
+                message = await asyncio.wait_for(subscription.get(), LIVE_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"data: {message}\n\n"
@@ -0,0 +1,297 @@
+import csv
+import heapq
+import io
+import itertools
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+from operator import itemgetter
+from typing import Optional, Iterator, Sequence
+
+import numpy as np
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
+from sqlmodel import Session, select
+
+from controller.archive import read_cold_track, iter_cold_track
+from controller.geofence import evaluate_geofences
+from controller.live import location_hub
+from controller.motion import update_motion
+from database import engine
+from models import Location, LocationBase, LocationRead, LocationIngestError, LastLocation, Device, DeviceIdentity
+from models.device import to_naive_local
+from utils.cache import TTLCache
+from utils.crud import GenericCRUD
+from utils.geo import geohash_encode, geohash_cover, haversine, radius_bounds
+from utils.track import downsample_indices
+
+NDJSON_MEDIA_TYPES = {"application/x-ndjson", "application/ndjson", "application/jsonl"}
+LAST_LOCATION_CACHE_SIZE = int(os.getenv("LAST_LOCATION_CACHE_SIZE", 100000))
+LAST_LOCATION_CACHE_TTL = float(os.getenv("LAST_LOCATION_CACHE_TTL", 60))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 5000))
+GEOHASH_PRECISION = int(os.getenv("GEOHASH_PRECISION", 9))
+AREA_QUERY_MAX_CELLS = int(os.getenv("AREA_QUERY_MAX_CELLS", 32))
+# Candidates fetched and filtered at a time, a search stops reading once it has limit matches
+AREA_QUERY_BATCH_SIZE = int(os.getenv("AREA_QUERY_BATCH_SIZE", 5000))
+CELL_BACKFILL_BATCH_SIZE = int(os.getenv("CELL_BACKFILL_BATCH_SIZE", 5000))
+
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv", "geojson": "application/geo+json"}
+LOCATION_COLUMNS = ("date", "latitude", "longitude")
+DEVICE_LOCATION_COLUMNS = ("device_id", *LOCATION_COLUMNS)
+
+logger = logging.getLogger(__name__)
+
+last_locations: TTLCache[uuid.UUID, LocationRead] = TTLCache(maxsize=LAST_LOCATION_CACHE_SIZE,
+                                                             ttl=LAST_LOCATION_CACHE_TTL)
+
+
+def parse_locations(body: bytes, content_type: Optional[str]) -> tuple[list[LocationBase], list[LocationIngestError]]:
+    media_type = (content_type or "").split(";", 1)[0].strip().lower()
+    try:
+        if media_type in NDJSON_MEDIA_TYPES:
+            items = [json.loads(line) for line in body.splitlines() if line.strip()]
+        else:
+            items = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed location batch")
+    if isinstance(items, dict):
+        items = [items]
+    if not isinstance(items, list):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Expected a location or a list of locations")
+
+    points: list[LocationBase] = []
+    errors: list[LocationIngestError] = []
+    for index, item in enumerate(items):
+        try:
+            points.append(LocationBase.model_validate(item))
+        except ValidationError as e:
+            detail = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" for error in e.errors())
+            errors.append(LocationIngestError(index=index, detail=detail))
+    return points, errors
+
+
+def write_locations(crud: GenericCRUD, batches: list[tuple[DeviceIdentity, list[LocationBase]]]) -> None:
+    # Several batches of the same Device, e.g. coalesced by the ingest buffer, are processed as one
+    devices: dict[uuid.UUID, tuple[DeviceIdentity, list[LocationBase]]] = {}
+    for device, points in batches:
+        if points:
+            devices.setdefault(device.device_id, (device, []))[1].extend(points)
+    if not devices:
+        return
+    points = [point for _, device_points in devices.values() for point in device_points]
+    cells = geohash_encode(np.fromiter((point.latitude for point in points), dtype=np.float64, count=len(points)),
+                           np.fromiter((point.longitude for point in points), dtype=np.float64, count=len(points)),
+                           GEOHASH_PRECISION)
+    device_ids = [device_id for device_id, (_, device_points) in devices.items() for _ in device_points]
+    rows = [{"id": uuid.uuid4(), "device_id": device_id, "cell": cell, **point.model_dump()}
+            for device_id, point, cell in zip(device_ids, points, cells)]
+
+    # A single commit for the batches and everything derived from them, a failure leaves none of it behind
+    last: dict[uuid.UUID, LocationRead] = {}
+    with crud.transaction():
+        crud.create_many(Location, rows)
+        # Always in the same order, so workers locking the rows of several Devices cannot deadlock
+        for device_id in sorted(devices):
+            device, device_points = devices[device_id]
+            location = update_last_location(crud, device_id, max(device_points, key=lambda point: point.date))
+            if location:
+                last[device_id] = location
+            update_motion(crud, device_id, device_points)
+            evaluate_geofences(crud, device_id, device.owner_id, device_points)
+    for device_id, location in last.items():
+        last_locations.set(device_id, location)
+    for device_id, (_, device_points) in devices.items():
+        location_hub.publish(device_id, device_points)
+
+
+def update_last_location(crud: GenericCRUD, device_id: uuid.UUID, point: LocationBase) -> Optional[LocationRead]:
+    known = last_locations.get(device_id)
+    if known and known.date >= point.date:
+        return None
+    # The WHERE keeps out-of-order batches, possibly from other workers, from moving the position back in time
+    written = crud.upsert(LastLocation, {"device_id": device_id, **point.model_dump()}, index_elements=["device_id"],
+                          set_=lambda excluded: {"date": excluded.date, "latitude": excluded.latitude,
+                                                 "longitude": excluded.longitude},
+                          where=lambda excluded: LastLocation.date < excluded.date)
+    if not written:
+        # Another worker stored a newer position, the next read loads it
+        last_locations.evict(device_id)
+        return None
+    return LocationRead.model_validate(point.model_dump())
+
+
+def read_last_location(session: Session, device_id: uuid.UUID) -> Optional[LocationRead]:
+    location = last_locations.get(device_id)
+    if location:
+        return location
+    row = session.get(LastLocation, device_id)
+    if not row:
+        return None
+    location = LocationRead.model_validate(row.model_dump())
+    last_locations.set(device_id, location)
+    return location
+
+
+def _columns(rows: list[tuple], names: tuple[str, ...]) -> dict[str, tuple]:
+    return dict(zip(names, zip(*rows) if rows else [()] * len(names)))
+
+
+def read_last_locations(session: Session, owner_id: uuid.UUID) -> dict[str, tuple]:
+    sel = (select(LastLocation.device_id, LastLocation.date, LastLocation.latitude, LastLocation.longitude)
+           .join(Device, Device.id == LastLocation.device_id).where(Device.owner_id == owner_id))
+    return _columns(session.exec(sel).all(), DEVICE_LOCATION_COLUMNS)
+
+
+def _track_select(device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime]):
+    sel = select(Location.date, Location.latitude, Location.longitude).where(Location.device_id == device_id)
+    if start:
+        sel = sel.where(Location.date >= to_naive_local(start))
+    if end:
+        sel = sel.where(Location.date < to_naive_local(end))
+    return sel.order_by(Location.date)
+
+
+def load_track(session: Session, device_id: uuid.UUID, start: Optional[datetime] = None,
+               end: Optional[datetime] = None) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    cold = read_cold_track(device_id, start, end)
+    rows = session.exec(_track_select(device_id, start, end)).all()
+    if not rows:
+        return cold
+    dates, latitudes, longitudes = zip(*rows)
+    hot = (np.array(dates, dtype="datetime64[us]"), np.array(latitudes, dtype=np.float64),
+           np.array(longitudes, dtype=np.float64))
+    if not len(cold[0]):
+        return hot
+    # Cold segments normally end where the table starts, late uploads of old points can still interleave
+    dates, latitudes, longitudes = (np.concatenate(parts) for parts in zip(cold, hot))
+    order = np.argsort(dates, kind="stable")
+    return dates[order], latitudes[order], longitudes[order]
+
+
+def read_history(session: Session, device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime],
+                 max_points: int, method: str) -> dict[str, np.ndarray]:
+    dates, latitudes, longitudes = load_track(session, device_id, start, end)
+    indices = downsample_indices(dates, latitudes, longitudes, max_points, method)
+    # Left as arrays, the response encodes them without a model per point
+    return dict(zip(LOCATION_COLUMNS, (dates[indices], latitudes[indices], longitudes[indices])))
+
+
+def iter_track(device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime]) -> Iterator[list[tuple]]:
+    # Runs after the request scoped session is gone, so the stream owns its session and server side cursor
+    with Session(engine) as session:
+        sel = _track_select(device_id, start, end).execution_options(yield_per=EXPORT_BATCH_SIZE)
+        hot = itertools.chain.from_iterable(session.exec(sel).partitions())
+        rows = heapq.merge(iter_cold_track(device_id, start, end), hot, key=itemgetter(0))
+        while batch := list(itertools.islice(rows, EXPORT_BATCH_SIZE)):
+            yield batch
+
+
+def _export_ndjson(batches: Iterator[list[tuple]]) -> Iterator[str]:
+    for batch in batches:
+        yield "".join(json.dumps({"date": date.isoformat(), "latitude": latitude, "longitude": longitude}) + "\n"
+                      for date, latitude, longitude in batch)
+
+
+def _export_csv(batches: Iterator[list[tuple]]) -> Iterator[str]:
+    yield "date,latitude,longitude\r\n"
+    for batch in batches:
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows((date.isoformat(), latitude, longitude) for date, latitude, longitude in batch)
+        yield buffer.getvalue()
+
+
+def _export_geojson(batches: Iterator[list[tuple]]) -> Iterator[str]:
+    yield '{"type":"FeatureCollection","features":['
+    separator = ""
+    for batch in batches:
+        features = ",".join(json.dumps({"type": "Feature", "geometry": {"type": "Point",
+                                                                         "coordinates": [longitude, latitude]},
+                                        "properties": {"date": date.isoformat()}})
+                            for date, latitude, longitude in batch)
+        if features:
+            yield separator + features
+            separator = ","
+    yield "]}"
+
+
+def export_track(device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime],
+                 export_format: str) -> Iterator[str]:
+    exporters = {"ndjson": _export_ndjson, "csv": _export_csv, "geojson": _export_geojson}
+    return exporters[export_format](iter_track(device_id, start, end))
+
+
+def search_area(session: Session, min_latitude: float, min_longitude: float, max_latitude: float,
+                max_longitude: float, start: Optional[datetime], end: Optional[datetime],
+                owner_id: Optional[uuid.UUID], limit: int,
+                center: Optional[tuple[float, float, float]] = None) -> dict[str, Sequence]:
+    prefixes = geohash_cover(min_latitude, min_longitude, max_latitude, max_longitude, GEOHASH_PRECISION,
+                             AREA_QUERY_MAX_CELLS)
+    sel = select(Location.device_id, Location.date, Location.latitude, Location.longitude)
+    if start:
+        sel = sel.where(Location.date >= to_naive_local(start))
+    if end:
+        sel = sel.where(Location.date < to_naive_local(end))
+    if owner_id:
+        sel = sel.join(Device, Device.id == Location.device_id).where(Device.owner_id == owner_id)
+
+    matches: list[tuple] = []
+    for prefix in prefixes:
+        # Geohash characters sort below "{", so each prefix is a range of the (cell, date) index. Read one range at
+        # a time in index order, the database streams it without sorting and reading stops once limit is reached
+        result = session.exec(sel.where(Location.cell >= prefix, Location.cell < prefix + "{")
+                              .order_by(Location.cell, Location.date)
+                              .execution_options(yield_per=AREA_QUERY_BATCH_SIZE))
+        for rows in result.partitions():
+            device_ids, dates, latitudes, longitudes = zip(*rows)
+            latitudes = np.array(latitudes, dtype=np.float64)
+            longitudes = np.array(longitudes, dtype=np.float64)
+            # The cells over-approximate the area, the exact filter runs vectorized over each batch of candidates
+            mask = ((latitudes >= min_latitude) & (latitudes <= max_latitude)
+                    & (longitudes >= min_longitude) & (longitudes <= max_longitude))
+            if center:
+                mask &= haversine(latitudes, longitudes, center[0], center[1]) <= center[2]
+            matches += [rows[index] for index in np.flatnonzero(mask)[:limit - len(matches)].tolist()]
+            if len(matches) >= limit:
+                break
+        result.close()
+        if len(matches) >= limit:
+            break
+    return _columns(matches, DEVICE_LOCATION_COLUMNS)
+
+
+def _backfill_cells_batch() -> int:
+    with Session(engine) as session:
+        sel = (select(Location.id, Location.latitude, Location.longitude).where(Location.cell == "")
+               .limit(CELL_BACKFILL_BATCH_SIZE))
+        rows = session.exec(sel).all()
+        if not rows:
+            return 0
+        ids, latitudes, longitudes = zip(*rows)
+        cells = geohash_encode(np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64),
+                               GEOHASH_PRECISION)
+        updates = [{"id": obj_id, "cell": cell} for obj_id, cell in zip(ids, cells.tolist())]
+        GenericCRUD(session).update_many(Location, updates)
+        return len(updates)
+
+
+async def backfill_cells() -> None:
+    # Locations stored before cells were computed on write have an empty one, which no area search matches. Runs
+    # batch by batch in the background, concurrent workers only repeat the same updates
+    total = 0
+    try:
+        while filled := await run_in_threadpool(_backfill_cells_batch):
+            total += filled
+    except Exception:
+        logger.exception("Geohash cell backfill failed")
+    if total:
+        logger.info("Computed the geohash cells of %d locations", total)
+
+
+def search_radius(session: Session, latitude: float, longitude: float, radius: float, start: Optional[datetime],
+                  end: Optional[datetime], owner_id: Optional[uuid.UUID], limit: int) -> dict[str, Sequence]:
+    return search_area(session, *radius_bounds(latitude, longitude, radius), start, end, owner_id, limit,
+                       center=(latitude, longitude, radius))
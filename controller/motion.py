@@ -0,0 +1,157 @@
+import os
+import uuid
+from datetime import datetime, date
+from typing import Optional
+
+import numpy as np
+from sqlalchemy import func
+from sqlmodel import Session, select
+
+from models import LocationBase, Trip, Stop, DailyStats, MotionState, StatsSummary
+from models.device import to_naive_local
+from utils.cache import TTLCache
+from utils.crud import GenericCRUD
+from utils.geo import haversine_distance
+
+# A Device that stays within STOP_RADIUS meters for at least STOP_MIN_DURATION seconds is stopped
+STOP_RADIUS = float(os.getenv("STOP_RADIUS", 100))
+STOP_MIN_DURATION = float(os.getenv("STOP_MIN_DURATION", 300))
+MOTION_STATE_CACHE_SIZE = int(os.getenv("MOTION_STATE_CACHE_SIZE", 100000))
+MOTION_STATE_CACHE_TTL = float(os.getenv("MOTION_STATE_CACHE_TTL", 3600))
+
+# Devices known to have a MotionState, their batches skip the insert and only lock it
+motion_devices: TTLCache[uuid.UUID, bool] = TTLCache(maxsize=MOTION_STATE_CACHE_SIZE, ttl=MOTION_STATE_CACHE_TTL)
+
+
+def _lock_state(session: Session, device_id: uuid.UUID) -> Optional[tuple[MotionState, Optional[Trip], Optional[Stop]]]:
+    # The open Trip and Stop come with the state, only the state row is locked
+    sel = (select(MotionState, Trip, Stop).outerjoin(Trip, Trip.id == MotionState.trip_id)
+           .outerjoin(Stop, Stop.id == MotionState.stop_id).where(MotionState.device_id == device_id)
+           .with_for_update(of=MotionState))
+    return session.exec(sel).first()
+
+
+def update_motion(crud: GenericCRUD, device_id: uuid.UUID, points: list[LocationBase]) -> None:
+    session = crud.session
+    points = sorted(points, key=lambda point: point.date)
+    # Locks the state row, so batches of the same Device on different workers are processed one after another
+    row = _lock_state(session, device_id) if motion_devices.get(device_id) else None
+    created = False
+    if row is None:
+        # Concurrent first batches of a Device do not conflict, the later insert waits for the earlier one and skips
+        first = points[0]
+        created = crud.insert_missing(MotionState, {
+            "device_id": device_id, "date": first.date, "latitude": first.latitude, "longitude": first.longitude,
+            "anchor_date": first.date, "anchor_latitude": first.latitude, "anchor_longitude": first.longitude,
+        }, index_elements=["device_id"])
+        row = _lock_state(session, device_id)
+        motion_devices.set(device_id, True)
+    state, trip, stop = row
+    if created:
+        previous = None
+    else:
+        # Points older than the state were uploaded late, they are stored but do not change the derived tables
+        points = [point for point in points if point.date > state.date]
+        previous = state
+    if not points:
+        return
+
+    distances = np.zeros(len(points))
+    durations = np.zeros(len(points))
+    moving = np.zeros(len(points), dtype=bool)
+
+    for index, point in enumerate(points):
+        if previous is not None:
+            distances[index] = haversine_distance(previous.latitude, previous.longitude, point.latitude,
+                                                  point.longitude)
+            durations[index] = (point.date - previous.date).total_seconds()
+
+        if haversine_distance(state.anchor_latitude, state.anchor_longitude, point.latitude,
+                              point.longitude) <= STOP_RADIUS:
+            if stop:
+                stop.end = point.date
+            elif (point.date - state.anchor_date).total_seconds() >= STOP_MIN_DURATION:
+                if trip:
+                    trip.end = state.anchor_date
+                    trip.end_latitude, trip.end_longitude = state.anchor_latitude, state.anchor_longitude
+                    trip = None
+                stop = Stop(device_id=device_id, start=state.anchor_date, end=point.date,
+                            latitude=state.anchor_latitude, longitude=state.anchor_longitude)
+                session.add(stop)
+        else:
+            state.anchor_date = point.date
+            state.anchor_latitude, state.anchor_longitude = point.latitude, point.longitude
+            stop = None
+            if not trip and previous is not None:
+                trip = Trip(device_id=device_id, start=previous.date, end=previous.date, points=1,
+                            start_latitude=previous.latitude, start_longitude=previous.longitude,
+                            end_latitude=previous.latitude, end_longitude=previous.longitude)
+                session.add(trip)
+
+        if trip:
+            trip.distance += float(distances[index])
+            trip.points += 1
+            trip.end = point.date
+            trip.end_latitude, trip.end_longitude = point.latitude, point.longitude
+            moving[index] = True
+        previous = point
+
+    last = points[-1]
+    state.date, state.latitude, state.longitude = last.date, last.latitude, last.longitude
+    state.trip_id = trip.id if trip else None
+    state.stop_id = stop.id if stop else None
+    session.add(state)
+
+    days, inverse = np.unique(np.array([point.date for point in points], dtype="datetime64[D]"), return_inverse=True)
+    distance = np.bincount(inverse, weights=distances * moving, minlength=len(days))
+    moving_time = np.bincount(inverse, weights=durations * moving, minlength=len(days))
+    counts = np.bincount(inverse, minlength=len(days))
+    rows = [{"device_id": device_id, "day": day, "distance": float(distance[position]),
+             "moving_time": float(moving_time[position]), "points": int(counts[position])}
+            for position, day in enumerate(days.tolist())]
+    # Adds to the existing rows instead of recomputing them
+    crud.upsert_many(DailyStats, rows, index_elements=["device_id", "day"],
+                     set_=lambda excluded: {"distance": DailyStats.distance + excluded.distance,
+                                            "moving_time": DailyStats.moving_time + excluded.moving_time,
+                                            "points": DailyStats.points + excluded.points})
+
+
+def read_trips(session: Session, device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime],
+               limit: int) -> list[Trip]:
+    sel = select(Trip).where(Trip.device_id == device_id)
+    if start:
+        sel = sel.where(Trip.end >= to_naive_local(start))
+    if end:
+        sel = sel.where(Trip.start < to_naive_local(end))
+    return list(session.exec(sel.order_by(Trip.start).limit(limit)).all())
+
+
+def read_stops(session: Session, device_id: uuid.UUID, start: Optional[datetime], end: Optional[datetime],
+               limit: int) -> list[Stop]:
+    sel = select(Stop).where(Stop.device_id == device_id)
+    if start:
+        sel = sel.where(Stop.end >= to_naive_local(start))
+    if end:
+        sel = sel.where(Stop.start < to_naive_local(end))
+    return list(session.exec(sel.order_by(Stop.start).limit(limit)).all())
+
+
+def _stats_select(sel, device_id: uuid.UUID, start: Optional[date], end: Optional[date]):
+    sel = sel.where(DailyStats.device_id == device_id)
+    if start:
+        sel = sel.where(DailyStats.day >= start)
+    if end:
+        sel = sel.where(DailyStats.day <= end)
+    return sel
+
+
+def read_daily_stats(session: Session, device_id: uuid.UUID, start: Optional[date],
+                     end: Optional[date]) -> list[DailyStats]:
+    return list(session.exec(_stats_select(select(DailyStats), device_id, start, end).order_by(DailyStats.day)).all())
+
+
+def summarize_stats(session: Session, device_id: uuid.UUID, start: Optional[date], end: Optional[date]) -> StatsSummary:
+    sel = select(func.coalesce(func.sum(DailyStats.distance), 0), func.coalesce(func.sum(DailyStats.moving_time), 0),
+                 func.coalesce(func.sum(DailyStats.points), 0), func.count())
+    distance, moving_time, points, days = session.exec(_stats_select(sel, device_id, start, end)).one()
+    return StatsSummary(start=start, end=end, distance=distance, moving_time=moving_time, points=points, days=days)
@@ -1,7 +1,43 @@
 import os
 
+from sqlalchemy import make_url, event, Engine
+from sqlalchemy.ext.asyncio import create_async_engine
 from sqlmodel import create_engine
 
 DATABASE_URL = os.getenv("DATABASE_URL")
+# e.g. postgresql+asyncpg://... or sqlite+aiosqlite:///..., pointing at the same database as DATABASE_URL
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 10))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "true").lower() in ("1", "true", "yes")
 
-engine = create_engine(DATABASE_URL)
+
+def engine_options(url: str) -> dict:
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+    # SQLite picks its own pool class, which does not accept the sizing arguments
+    if make_url(url).get_backend_name() != "sqlite":
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+
+def _enable_foreign_keys(dbapi_connection, _) -> None:
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA foreign_keys=ON")
+    cursor.close()
+
+
+def enforce_foreign_keys(engine: Engine) -> Engine:
+    # SQLite ignores foreign keys unless enabled per connection, and with them the ondelete cascades that bulk
+    # deletes rely on for the tables without an ORM relationship
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _enable_foreign_keys)
+    return engine
+
+
+engine = enforce_foreign_keys(create_engine(DATABASE_URL, **engine_options(DATABASE_URL)))
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL)) \
+    if ASYNC_DATABASE_URL else None
+if async_engine:
+    enforce_foreign_keys(async_engine.sync_engine)
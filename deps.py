@@ -1,10 +1,18 @@
-from typing import Generator
+from typing import Generator, AsyncGenerator
 
 from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from database import engine
+from database import engine, async_engine
 
 
 def get_session() -> Generator[Session, None, None]:
     with Session(engine) as session:
         yield session
+
+
+async def get_async_session() -> AsyncGenerator[AsyncSession, None]:
+    if async_engine is None:
+        raise RuntimeError("ASYNC_DATABASE_URL is not configured")
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
@@ -1,43 +1,98 @@
 import os
+import uuid
+from datetime import datetime
 
 from fastapi import FastAPI
-from sqlmodel import SQLModel, Session
+from sqlalchemy import Connection, text, inspect
+from sqlmodel import SQLModel, select
 
 from controller.auth import ScopeValidator
 from database import engine
-from models import User, Role
-from models.user import Scope
-from utils.crud import GenericCRUD
+from models import User, Role, Location
+from models.user import Scope, RoleScopeLink, UserRoleLink
+from utils.crud import dialect_insert
+from utils.passwords import pwd_context
+
+# Arbitrary, only has to be the same for every worker
+BOOTSTRAP_LOCK_KEY = 0x74726163
+# Columns added to tables that databases of earlier versions already have, create_all only creates missing tables.
+# Each with the SQL literal existing rows get
+ADDED_COLUMNS = [
+    (User, "permission_version", "0"),
+    (Location, "date", "'1970-01-01 00:00:00'"),
+    (Location, "latitude", "0"),
+    (Location, "longitude", "0"),
+    (Location, "cell", "''"),
+]
+
+
+def _insert_missing(connection: Connection, model, rows: list[dict], index_elements: list[str]) -> None:
+    if rows:
+        stmt = dialect_insert(connection.dialect.name, model).on_conflict_do_nothing(index_elements=index_elements)
+        connection.execute(stmt, rows)
+
+
+def _named_ids(connection: Connection, model, names: list[str]) -> dict[str, uuid.UUID]:
+    return dict(connection.execute(select(model.name, model.id).where(model.name.in_(names))).all())
+
+
+def _add_missing_columns(connection: Connection) -> None:
+    inspector = inspect(connection)
+    preparer = connection.dialect.identifier_preparer
+    existing = {}
+    for model, name, default in ADDED_COLUMNS:
+        table = model.__table__
+        if table.name not in existing:
+            existing[table.name] = {column["name"] for column in inspector.get_columns(table.name)}
+        if name in existing[table.name]:
+            continue
+        column = table.c[name]
+        definition = f"{preparer.format_column(column)} {column.type.compile(connection.dialect)} NOT NULL"
+        connection.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {definition} "
+                                f"DEFAULT {default}"))
+    # Likewise, indexes are only created along with their table
+    for table in SQLModel.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(connection, checkfirst=True)
 
 
 def init_database(app: FastAPI):
-    SQLModel.metadata.create_all(engine)
-    with Session(engine) as session:
-        crud = GenericCRUD(session=session)
+    # One transaction for everything. Its lock makes concurrently starting workers wait for the first one instead
+    # of racing it, the others then find nothing left to insert
+    with engine.begin() as connection:
+        if connection.dialect.name == "postgresql":
+            connection.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": BOOTSTRAP_LOCK_KEY})
+        elif connection.dialect.name == "sqlite":
+            # pysqlite would only begin the transaction at the first insert, after the DDL
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+        SQLModel.metadata.create_all(connection)
+        _add_missing_columns(connection)
 
-        # Admin user
+        # Admin user, only hashed when it has to be created
         username = os.getenv("ADMIN_USERNAME", "admin")
-        password = os.getenv("ADMIN_PASSWORD", "admin")
-        admin_user = crud.read_raw(User, name___is=username)
-        if not admin_user:
-            admin_user = crud.create(User, **{"name": username, "password": password})
+        admin_id = _named_ids(connection, User, [username]).get(username)
+        if not admin_id:
+            password = pwd_context.hash(os.getenv("ADMIN_PASSWORD", "admin"))
+            _insert_missing(connection, User, [{"id": uuid.uuid4(), "name": username, "password": password,
+                                                "created": datetime.now(), "permission_version": 0}], ["name"])
+            admin_id = _named_ids(connection, User, [username])[username]
 
         # Admin role
-        admin_role = crud.read_raw(Role, name___is="admin")
-        if not admin_role:
-            admin_role = crud.create(Role, **{"name": "admin"})
-
-        # Scopes
-        for scope_name in ScopeValidator.registered_scopes:
-            scope = crud.read_raw(Scope, name___is=scope_name)
-            if not scope:
-                scope = crud.create(Scope, **{"name": scope_name})
-            # Assign scopes to admin role
-            if scope not in admin_role.scopes:
-                admin_role.scopes.append(scope)
-            crud.refresh(admin_role)
+        _insert_missing(connection, Role, [{"id": uuid.uuid4(), "name": "admin"}], ["name"])
+        admin_role_id = _named_ids(connection, Role, ["admin"])["admin"]
+
+        # Scopes, all assigned to the admin role
+        names = sorted(ScopeValidator.registered_scopes)
+        existing = _named_ids(connection, Scope, names)
+        _insert_missing(connection, Scope, [{"id": uuid.uuid4(), "name": name} for name in names
+                                            if name not in existing], ["name"])
+        scope_ids = _named_ids(connection, Scope, names) if len(existing) < len(names) else existing
+        linked = set(connection.execute(select(RoleScopeLink.scope_id)
+                                        .where(RoleScopeLink.role_id == admin_role_id)).scalars().all())
+        _insert_missing(connection, RoleScopeLink, [{"role_id": admin_role_id, "scope_id": scope_id}
+                                                    for scope_id in scope_ids.values() if scope_id not in linked],
+                        ["role_id", "scope_id"])
 
         # Assign admin role to admin user
-        if admin_role not in admin_user.roles:
-            admin_user.roles.append(admin_role)
-            crud.refresh(admin_user)
+        _insert_missing(connection, UserRoleLink, [{"user_id": admin_id, "role_id": admin_role_id}],
+                        ["user_id", "role_id"])
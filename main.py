@@ -1,31 +1,61 @@
+import asyncio
 import logging
+import os
 from contextlib import asynccontextmanager
 
+import anyio.to_thread
 from fastapi import FastAPI
 
+from controller.archive import COLD_STORAGE_PATH, COMPACTION_INTERVAL, compaction_loop
+from controller.ingest import INGEST_FLUSH_INTERVAL, ingest_buffer
+from controller.location import backfill_cells
+from database import engine, async_engine
 from init import init_database
 from models import *
-from routers import auth
+from routers import auth, metrics
 from routers.device import router
+from routers.geofence import GeofenceRouter
 from routers.role import RoleRouter
 from routers.scope import ScopeRouter
-from utils.router import UniqueNameRouter, Models
+from routers.user import UserRouter
+from utils import passwords
+from utils.metrics import MetricsMiddleware, instrument_engine
+
+WORKER_THREADS = os.getenv("WORKER_THREADS")
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.getLogger('passlib').setLevel(logging.ERROR)
+    if WORKER_THREADS:
+        # Sync routes and dependencies run in this pool; size it together with DB_POOL_SIZE + DB_MAX_OVERFLOW
+        anyio.to_thread.current_default_thread_limiter().total_tokens = int(WORKER_THREADS)
     init_database(app)
+    backfill = asyncio.create_task(backfill_cells())
+    compaction = asyncio.create_task(compaction_loop()) if COLD_STORAGE_PATH and COMPACTION_INTERVAL > 0 else None
+    if INGEST_FLUSH_INTERVAL > 0:
+        ingest_buffer.start()
     yield
+    # Before anything else shuts down, the buffered Locations still have to be committed
+    await ingest_buffer.close()
+    backfill.cancel()
+    if compaction:
+        compaction.cancel()
+    passwords.executor.shutdown(wait=False)
 
 
 app = FastAPI(lifespan=lifespan, swagger_ui_parameters={"operationsSorter": "method"})
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine, "sync")
+if async_engine:
+    instrument_engine(async_engine.sync_engine, "async")
 
-user_models = Models(base=User, create=UserCreate, read=UserRead, update=UserUpdate)
-app.include_router(UniqueNameRouter(user_models, tag="users", prefix="/users"))
+app.include_router(UserRouter())
 
 app.include_router(router)
 app.include_router(RoleRouter())
 app.include_router(ScopeRouter())
+app.include_router(GeofenceRouter())
 
 app.include_router(auth.router)
+app.include_router(metrics.router)
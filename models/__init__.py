@@ -1,3 +1,8 @@
 from .user import User, UserRead, UserUpdate, UserCreate, UserLogin, Role, RoleCreate
-from .auth import Token
-from .device import Device, Location, ApiKey, DeviceCreateOther, DeviceInfo, DeviceCreate
\ No newline at end of file
+from .auth import Token, TokenClaims
+from .device import Device, Location, ApiKey, DeviceCreateOther, DeviceInfo, DeviceCreate, DeviceIdentity, \
+    LocationBase, LocationRead, LastLocation, DeviceLocationRead, LocationIngestResult, LocationIngestError, \
+    LocationColumns, DeviceLocationColumns
+from .geofence import Geofence, GeofenceCreate, GeofenceRead, GeofenceUpdate, GeofenceEvent, GeofenceEventRead, \
+    GeofencePresence
+from .motion import Trip, TripRead, Stop, StopRead, DailyStats, DailyStatsRead, StatsSummary, MotionState
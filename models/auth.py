@@ -1,3 +1,5 @@
+import uuid
+
 from pydantic import BaseModel
 
 
@@ -5,3 +7,11 @@ class Token(BaseModel):
     access_token: str
     refresh_token: str
     token_type: str
+
+
+class TokenClaims(BaseModel):
+    sub: uuid.UUID
+    name: str
+    roles: list[str] = []
+    scopes: list[str] = []
+    pv: int = 0
@@ -4,7 +4,8 @@ import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlmodel import SQLModel, Field, Relationship
+from pydantic import field_validator
+from sqlmodel import SQLModel, Field, Relationship, Index
 
 from models import User
 from utils.models import NamedObject, ObjectIdentifier
@@ -35,11 +36,18 @@ class DeviceInfo(DeviceBase):
 class Device(DeviceInfo, table=True):
     user: User = Relationship(back_populates="devices")
     locations: list["Location"] = Relationship(back_populates="device", cascade_delete=True)
+    last_location: Optional["LastLocation"] = Relationship(cascade_delete=True,
+                                                           sa_relationship_kwargs={"uselist": False})
 
     apikey: Optional[ApiKey] = Relationship(back_populates="device",
                                             sa_relationship_kwargs={"cascade": "all, delete-orphan", "uselist": False})
 
 
+class DeviceIdentity(SQLModel):
+    device_id: uuid.UUID
+    owner_id: uuid.UUID
+
+
 class DeviceCreateOther(SQLModel):
     name: str
     description: str
@@ -53,11 +61,61 @@ class DeviceCreate(SQLModel):
 
 class LocationBase(SQLModel):
     date: datetime = Field(default_factory=datetime.now)
-    latitude: float = Field()
-    longitude: float = Field()
+    latitude: float = Field(ge=-90, le=90)
+    longitude: float = Field(ge=-180, le=180)
+
+    @field_validator('date')
+    def normalize_date(cls, value: datetime) -> datetime:
+        return to_naive_local(value)
+
+
+def to_naive_local(value: datetime) -> datetime:
+    # Stored timestamps are naive local time, like every other datetime column
+    if value.tzinfo is not None:
+        return value.astimezone().replace(tzinfo=None)
+    return value
 
 
-class Location(ObjectIdentifier, table=True):
+class Location(ObjectIdentifier, LocationBase, table=True):
+    __table_args__ = (Index("ix_location_device_id_date", "device_id", "date"),
+                      Index("ix_location_cell_date", "cell", "date"))
+
     device_id: uuid.UUID = Field(foreign_key="device.id")
+    # Geohash of the position, prefix ranges of it prune spatial queries
+    cell: str = Field(default="", max_length=12)
 
     device: Device = Relationship(back_populates="locations")
+
+
+class LastLocation(LocationBase, table=True):
+    device_id: uuid.UUID = Field(foreign_key="device.id", primary_key=True)
+
+
+class LocationRead(LocationBase):
+    pass
+
+
+class DeviceLocationRead(LocationRead):
+    device_id: uuid.UUID
+
+
+# Columnar layout of a list of Locations, the n-th entries of all arrays belong together
+class LocationColumns(SQLModel):
+    date: list[datetime]
+    latitude: list[float]
+    longitude: list[float]
+
+
+class DeviceLocationColumns(LocationColumns):
+    device_id: list[uuid.UUID]
+
+
+class LocationIngestError(SQLModel):
+    index: int
+    detail: str
+
+
+class LocationIngestResult(SQLModel):
+    accepted: int
+    rejected: int
+    errors: list[LocationIngestError] = []
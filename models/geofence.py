@@ -0,0 +1,85 @@
+import uuid
+from datetime import datetime
+from typing import Optional, Literal
+
+from sqlalchemy import Column, JSON
+from sqlmodel import SQLModel, Field, Relationship, Index
+
+from utils.models import NamedObject, ObjectIdentifier
+
+
+class GeofenceGeometry(SQLModel):
+    kind: Literal["circle", "polygon"]
+    latitude: Optional[float] = Field(default=None, ge=-90, le=90)
+    longitude: Optional[float] = Field(default=None, ge=-180, le=180)
+    radius: Optional[float] = Field(default=None, gt=0)
+    # Polygon vertices as [latitude, longitude] pairs
+    vertices: Optional[list[list[float]]] = None
+
+
+class Geofence(NamedObject, table=True):
+    owner_id: uuid.UUID = Field(foreign_key="user.id", index=True, ondelete="CASCADE")
+    device_id: Optional[uuid.UUID] = Field(default=None, foreign_key="device.id", ondelete="CASCADE")
+    kind: str = Field(max_length=16)
+    latitude: Optional[float] = Field(default=None)
+    longitude: Optional[float] = Field(default=None)
+    radius: Optional[float] = Field(default=None)
+    vertices: Optional[list[list[float]]] = Field(default=None, sa_column=Column(JSON))
+    min_latitude: float = Field()
+    min_longitude: float = Field()
+    max_latitude: float = Field()
+    max_longitude: float = Field()
+
+    events: list["GeofenceEvent"] = Relationship(back_populates="geofence", cascade_delete=True)
+    presences: list["GeofencePresence"] = Relationship(cascade_delete=True)
+
+
+class GeofenceCreate(GeofenceGeometry):
+    name: str
+    owner_id: uuid.UUID
+    device_id: Optional[uuid.UUID] = None
+
+
+class GeofenceRead(GeofenceGeometry):
+    id: uuid.UUID
+    name: str
+    owner_id: uuid.UUID
+    device_id: Optional[uuid.UUID]
+
+
+class GeofenceUpdate(SQLModel):
+    name: Optional[str] = None
+    latitude: Optional[float] = Field(default=None, ge=-90, le=90)
+    longitude: Optional[float] = Field(default=None, ge=-180, le=180)
+    radius: Optional[float] = Field(default=None, gt=0)
+    vertices: Optional[list[list[float]]] = None
+
+
+class GeofencePresence(SQLModel, table=True):
+    geofence_id: uuid.UUID = Field(foreign_key="geofence.id", primary_key=True, ondelete="CASCADE")
+    device_id: uuid.UUID = Field(foreign_key="device.id", primary_key=True, ondelete="CASCADE")
+    since: datetime = Field()
+
+
+class GeofenceEvent(ObjectIdentifier, table=True):
+    __table_args__ = (Index("ix_geofenceevent_geofence_id_date", "geofence_id", "date"),
+                      Index("ix_geofenceevent_device_id_date", "device_id", "date"))
+
+    geofence_id: uuid.UUID = Field(foreign_key="geofence.id", ondelete="CASCADE")
+    device_id: uuid.UUID = Field(foreign_key="device.id", ondelete="CASCADE")
+    kind: str = Field(max_length=8)
+    date: datetime = Field()
+    latitude: float = Field()
+    longitude: float = Field()
+
+    geofence: Geofence = Relationship(back_populates="events")
+
+
+class GeofenceEventRead(SQLModel):
+    id: uuid.UUID
+    geofence_id: uuid.UUID
+    device_id: uuid.UUID
+    kind: str
+    date: datetime
+    latitude: float
+    longitude: float
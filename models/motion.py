@@ -0,0 +1,87 @@
+import uuid
+from datetime import datetime, date
+from typing import Optional
+
+from sqlmodel import SQLModel, Field, Index
+
+from utils.models import ObjectIdentifier
+
+
+class TripBase(SQLModel):
+    start: datetime
+    end: datetime
+    start_latitude: float
+    start_longitude: float
+    end_latitude: float
+    end_longitude: float
+    # Meters
+    distance: float = 0
+    points: int = 0
+
+
+class Trip(ObjectIdentifier, TripBase, table=True):
+    __table_args__ = (Index("ix_trip_device_id_start", "device_id", "start"),)
+
+    device_id: uuid.UUID = Field(foreign_key="device.id", ondelete="CASCADE")
+
+
+class TripRead(TripBase):
+    id: uuid.UUID
+    device_id: uuid.UUID
+
+
+class StopBase(SQLModel):
+    start: datetime
+    end: datetime
+    latitude: float
+    longitude: float
+
+
+class Stop(ObjectIdentifier, StopBase, table=True):
+    __table_args__ = (Index("ix_stop_device_id_start", "device_id", "start"),)
+
+    device_id: uuid.UUID = Field(foreign_key="device.id", ondelete="CASCADE")
+
+
+class StopRead(StopBase):
+    id: uuid.UUID
+    device_id: uuid.UUID
+
+
+class DailyStatsBase(SQLModel):
+    # Meters and seconds spent in trips
+    distance: float = 0
+    moving_time: float = 0
+    points: int = 0
+
+
+class DailyStats(DailyStatsBase, table=True):
+    device_id: uuid.UUID = Field(foreign_key="device.id", primary_key=True, ondelete="CASCADE")
+    day: date = Field(primary_key=True)
+
+
+class DailyStatsRead(DailyStatsBase):
+    day: date
+
+
+class StatsSummary(SQLModel):
+    start: Optional[date]
+    end: Optional[date]
+    distance: float
+    moving_time: float
+    points: int
+    days: int
+
+
+class MotionState(SQLModel, table=True):
+    device_id: uuid.UUID = Field(foreign_key="device.id", primary_key=True, ondelete="CASCADE")
+    # Last processed point
+    date: datetime
+    latitude: float
+    longitude: float
+    # Where the Device has been lingering since anchor_date, the center of a Stop once it lingers long enough
+    anchor_date: datetime
+    anchor_latitude: float
+    anchor_longitude: float
+    trip_id: Optional[uuid.UUID] = None
+    stop_id: Optional[uuid.UUID] = None
@@ -2,13 +2,11 @@ import uuid
 from datetime import datetime
 from typing import Optional
 
-from passlib.context import CryptContext
 from pydantic import field_validator
 from sqlmodel import SQLModel, Field, Relationship
 
 from utils.models import ObjectIdentifier, NamedObject
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from utils.passwords import pwd_context, HashedPassword
 
 
 class RoleScopeLink(SQLModel, table=True):
@@ -40,17 +38,24 @@ class RoleCreate(SQLModel):
 
 class RoleRead(NamedObject):
     scopes: list["Scope"]
+    # The first users by id only, the complete list is paginated separately
     users: list["UserRead"]
+    user_count: int = 0
 
 
 class User(NamedObject, table=True):
     created: datetime = Field(default_factory=datetime.now, nullable=False)
     password: str = Field()
+    permission_version: int = Field(default=0, nullable=False)
     roles: list[Role] = Relationship(back_populates="users", link_model=UserRoleLink)
     devices: list["Device"] = Relationship(back_populates="user", cascade_delete=True)
+    geofences: list["Geofence"] = Relationship(cascade_delete=True)
 
-    @field_validator('password')
+    @field_validator('password', mode='before')
     def hash_password(cls, value: str) -> str:
+        # Routes hash in the password pool beforehand and mark the result, anything else is hashed here
+        if isinstance(value, HashedPassword):
+            return str(value)
         return pwd_context.hash(value)
 
     class Config:
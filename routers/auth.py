@@ -1,6 +1,7 @@
 from typing import Annotated
 
 from fastapi import APIRouter, Depends
+from fastapi.concurrency import run_in_threadpool
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlmodel import Session
 
@@ -12,6 +13,6 @@ router = APIRouter(tags=["auth"])
 
 
 @router.post("/token", response_model=Token)
-def login(user_login: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_session)):
-    user = auth.auth_user(UserLogin(name=user_login.username, password=user_login.password), db)
-    return auth.create_token(user)
+async def login(user_login: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_session)):
+    user = await auth.auth_user(UserLogin(name=user_login.username, password=user_login.password), db)
+    return await run_in_threadpool(auth.create_token, user)
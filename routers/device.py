@@ -1,54 +1,335 @@
+import asyncio
 import uuid
+from datetime import datetime, date
+from typing import Optional, Literal, Union
 
-from fastapi import Depends, status, HTTPException
+from fastapi import Depends, status, HTTPException, Request, Query, WebSocket, WebSocketException, Body, \
+    WebSocketDisconnect
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from fastapi_utils.cbv import cbv
+from sqlmodel import Session, select
+from typing_extensions import override
 
-from controller.auth import ScopeValidator, get_user, ImplicitScopeValidator
-from models import Device, DeviceCreate, DeviceInfo, ApiKey
+from controller.archive import drop_segments
+from controller.auth import ScopeValidator, get_user_id, ImplicitScopeValidator, get_device, apikey_cache, \
+    evict_device_apikeys, get_token_scopes
+from controller.live import location_hub, event_stream
+from controller.motion import read_trips, read_stops, read_daily_stats, summarize_stats
+from controller.ingest import ingest_buffer
+from controller.location import parse_locations, write_locations, read_history, read_last_location, \
+    read_last_locations, export_track, EXPORT_MEDIA_TYPES, search_area, search_radius
+from models import Device, DeviceCreate, DeviceInfo, ApiKey, DeviceIdentity, LocationIngestResult, LocationRead, \
+    DeviceLocationRead, TripRead, StopRead, DailyStatsRead, StatsSummary, LocationColumns, DeviceLocationColumns
+from database import engine
 from models import User
-from utils.models import ObjectIdentifier
-from utils.router import Models, UniqueNameRouter
+from utils.cache import CacheStats
+from utils.crud import GenericCRUD
+from utils.models import ObjectIdentifier, BatchItemResult
+from utils.router import Models, UniqueNameRouter, invalidate_responses, BATCH_MAX_ITEMS
+from utils.serialization import Layout, columns_response
 
-device_models = Models(base=Device, read=DeviceInfo)
+device_models = Models(base=Device, read=DeviceInfo, batch=True)
 
-router = UniqueNameRouter(device_models, tag="devices", prefix="/devices")
+
+class DeviceRouter(UniqueNameRouter):
+
+    @override
+    async def delete_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        await super().delete_item(obj_id, crud)
+        evict_device_apikeys(obj_id.id)
+        drop_segments(obj_id.id)
+
+    @override
+    async def delete_items(self, obj_ids: list[uuid.UUID], crud: GenericCRUD):
+        await super().delete_items(obj_ids, crud)
+        for obj_id in obj_ids:
+            evict_device_apikeys(obj_id)
+            drop_segments(obj_id)
+
+
+router = DeviceRouter(device_models, tag="devices", prefix="/devices")
 
 
 @cbv(router)
 class RouterExtension:
-    user: User = Depends(get_user)
+    user_id: uuid.UUID = Depends(get_user_id)
+    crud: GenericCRUD = Depends(router.get_crud)
     validator: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:apikey"))
 
+    def _read_devices(self, device_ids: set[uuid.UUID], others: ImplicitScopeValidator) -> set[uuid.UUID]:
+        owners = dict(self.crud.session.exec(select(Device.id, Device.owner_id).where(Device.id.in_(device_ids))).all())
+        for device_id in device_ids - owners.keys():
+            raise HTTPException(status_code=404, detail=f"Device with id {device_id} not found")
+        if any(owner_id != self.user_id for owner_id in owners.values()):
+            others.validate()
+        return device_ids
+
+    def _read_device(self, device_id: uuid.UUID, others: ImplicitScopeValidator) -> Device:
+        device: Device = self.crud.read_raw(Device, id___is=device_id)
+        if not device:
+            raise HTTPException(status_code=404, detail=f"Device with id {device_id} not found")
+        if device.owner_id != self.user_id:
+            others.validate()
+        return device
+
     @router.post("/", response_model=DeviceInfo, status_code=status.HTTP_201_CREATED,
                  description=f"Creates a new Device for the authenticated User",
                  name=f"Create a new Device")
     def create_device(self, device_create: DeviceCreate = Depends(),
                       _: None = Depends(ScopeValidator("devices:create"))):
-        router.validate_uniques(device_create, ObjectIdentifier(id=self.user.id))
-        return router.crud.create(Device, owner_id=self.user.id, **device_create.model_dump())
+        router.validate_uniques(device_create, self.crud)
+        with router.unique_violations(device_create):
+            device = self.crud.create(Device, owner_id=self.user_id, **device_create.model_dump())
+        invalidate_responses(Device)
+        return device
 
     @router.post("/others", response_model=DeviceInfo, status_code=status.HTTP_201_CREATED,
                  description=f"Creates a new Device for the specified User",
                  name=f"Create a new Device for another User")
     def create_device_others(self, user_id: uuid.UUID, device_create: DeviceCreate = Depends(),
                              _: None = Depends(ScopeValidator("devices:others:create"))):
-        if not router.crud.exists(User, id___is=user_id):
+        if not self.crud.exists(User, id___is=user_id):
             raise HTTPException(status_code=404, detail=f"User with id '{user_id}' not found")
-        router.validate_uniques(device_create, ObjectIdentifier(id=user_id))
-        return router.crud.create(Device, owner_id=user_id, **device_create.model_dump())
+        router.validate_uniques(device_create, self.crud)
+        with router.unique_violations(device_create):
+            device = self.crud.create(Device, owner_id=user_id, **device_create.model_dump())
+        invalidate_responses(Device)
+        return device
+
+    @router.post("/batch", response_model=list[BatchItemResult], status_code=status.HTTP_200_OK,
+                 description=f"Creates up to {BATCH_MAX_ITEMS} Devices for the authenticated User in a single "
+                             f"transaction, reporting a status per item",
+                 name=f"Create Devices in bulk")
+    async def create_devices(self, devices: list[DeviceCreate] = Body(),
+                             _: None = Depends(ScopeValidator("devices:create"))):
+        return await router.create_batch(devices, self.crud, owner_id=self.user_id)
+
+    @router.post("/others/batch", response_model=list[BatchItemResult], status_code=status.HTTP_200_OK,
+                 description=f"Creates up to {BATCH_MAX_ITEMS} Devices for the specified User in a single "
+                             f"transaction, reporting a status per item",
+                 name=f"Create Devices in bulk for another User")
+    async def create_devices_others(self, user_id: uuid.UUID, devices: list[DeviceCreate] = Body(),
+                                    _: None = Depends(ScopeValidator("devices:others:create"))):
+        if not await run_in_threadpool(self.crud.exists, User, id___is=user_id):
+            raise HTTPException(status_code=404, detail=f"User with id '{user_id}' not found")
+        return await router.create_batch(devices, self.crud, owner_id=user_id)
 
     @router.post("/apikey", response_model=ApiKey, status_code=status.HTTP_201_CREATED,
                  description=f"Generates a new ApiKey for the given Device",
                  name=f"Generates a new ApiKey")
     def create_apikey(self, device_id: uuid.UUID,
                       _: None = Depends(ScopeValidator("devices:others:apikey"))):
-        device: Device = router.crud.read_raw(Device, id___is=device_id)
-        if not device:
-            raise HTTPException(status_code=404, detail=f"Device with id {device_id} not found")
-        if device.owner_id != self.user.id:
-            self.validator.validate(self.user)
-        router.crud.delete_raw(ApiKey, device_id___is=device_id)
-        key: ApiKey = router.crud.create(ApiKey, device_id=device_id)
-        router.crud.refresh(device)
-        router.crud.refresh(key)
+        self._read_device(device_id, self.validator)
+        with self.crud.transaction():
+            self.crud.delete_raw(ApiKey, device_id___is=device_id)
+            key: ApiKey = self.crud.create(ApiKey, device_id=device_id)
+        # Only once the new key is committed, a concurrent lookup could otherwise cache the old one again
+        evict_device_apikeys(device_id)
         return key
+
+    @router.get("/{device_id}/locations", response_model=Union[list[LocationRead], LocationColumns],
+                description=f"Retrieves the track of the given Device between start and end, downsampled to at "
+                            f"most max_points points. The columns layout returns an array per field instead of "
+                            f"an object per point",
+                name=f"Retrieve the Location history of a Device")
+    def get_history(self, device_id: uuid.UUID, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                    max_points: int = Query(2000, ge=2, le=100000),
+                    method: Literal["simplify", "bucket"] = "simplify", layout: Layout = "rows",
+                    others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                    _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        return columns_response(read_history(self.crud.session, device_id, start, end, max_points, method), layout)
+
+    @router.get("/{device_id}/locations/export", response_class=StreamingResponse,
+                description=f"Streams the full track of the given Device between start and end as NDJSON, CSV or "
+                            f"GeoJSON",
+                name=f"Export the Location history of a Device")
+    def export_history(self, device_id: uuid.UUID, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       format: Literal["ndjson", "csv", "geojson"] = "ndjson",
+                       others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                       _: None = Depends(ScopeValidator("devices:locations:export"))):
+        self._read_device(device_id, others)
+        return StreamingResponse(export_track(device_id, start, end, format), media_type=EXPORT_MEDIA_TYPES[format],
+                                 headers={"Content-Disposition": f'attachment; filename="{device_id}.{format}"'})
+
+    @router.get("/{device_id}/locations/latest", response_model=LocationRead,
+                description=f"Retrieves the last known Location of the given Device",
+                name=f"Retrieve the last known Location of a Device")
+    def get_last_location(self, device_id: uuid.UUID,
+                          others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                          _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        location = read_last_location(self.crud.session, device_id)
+        if not location:
+            raise HTTPException(status_code=404, detail=f"Device with id {device_id} has no Location yet")
+        return location
+
+    @router.get("/{device_id}/trips", response_model=list[TripRead],
+                description=f"Retrieves the Trips of the given Device overlapping the window between start and end",
+                name=f"Retrieve the Trips of a Device")
+    def get_trips(self, device_id: uuid.UUID, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  limit: int = Query(1000, ge=1, le=10000),
+                  others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                  _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        return read_trips(self.crud.session, device_id, start, end, limit)
+
+    @router.get("/{device_id}/stops", response_model=list[StopRead],
+                description=f"Retrieves the Stops of the given Device overlapping the window between start and end",
+                name=f"Retrieve the Stops of a Device")
+    def get_stops(self, device_id: uuid.UUID, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                  limit: int = Query(1000, ge=1, le=10000),
+                  others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                  _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        return read_stops(self.crud.session, device_id, start, end, limit)
+
+    @router.get("/{device_id}/stats/daily", response_model=list[DailyStatsRead],
+                description=f"Retrieves distance, time moving and number of points of the given Device per day, "
+                            f"for the days from start to end inclusive",
+                name=f"Retrieve the daily statistics of a Device")
+    def get_daily_stats(self, device_id: uuid.UUID, start: Optional[date] = None, end: Optional[date] = None,
+                        others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                        _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        return read_daily_stats(self.crud.session, device_id, start, end)
+
+    @router.get("/{device_id}/stats", response_model=StatsSummary,
+                description=f"Sums distance, time moving and number of points of the given Device over the days "
+                            f"from start to end inclusive",
+                name=f"Summarize the statistics of a Device")
+    def get_stats(self, device_id: uuid.UUID, start: Optional[date] = None, end: Optional[date] = None,
+                  others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                  _: None = Depends(ScopeValidator("devices:locations:read"))):
+        self._read_device(device_id, others)
+        return summarize_stats(self.crud.session, device_id, start, end)
+
+    @router.get("/locations/latest", response_model=Union[list[DeviceLocationRead], DeviceLocationColumns],
+                description=f"Retrieves the last known Location of every Device owned by the given User, "
+                            f"defaulting to the authenticated User",
+                name=f"Retrieve the last known Locations of all Devices of a User")
+    def get_last_locations(self, user_id: Optional[uuid.UUID] = None, layout: Layout = "rows",
+                           others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                           _: None = Depends(ScopeValidator("devices:locations:read"))):
+        if user_id and user_id != self.user_id:
+            others.validate()
+        return columns_response(read_last_locations(self.crud.session, user_id or self.user_id), layout)
+
+    @router.get("/live/sse", response_class=StreamingResponse,
+                description=f"Streams new Locations of the given Devices as Server-Sent Events",
+                name=f"Follow Devices live via SSE")
+    def follow_devices_sse(self, device_id: list[uuid.UUID] = Query(),
+                           others: ImplicitScopeValidator = Depends(ImplicitScopeValidator("devices:others:locations")),
+                           _: None = Depends(ScopeValidator("devices:locations:read"))):
+        device_ids = self._read_devices(set(device_id), others)
+        # The stream may stay open for hours, it must not pin a pooled connection
+        self.crud.session.close()
+        return StreamingResponse(event_stream(device_ids), media_type="text/event-stream",
+                                 headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    @router.get("/locations/bbox", response_model=Union[list[DeviceLocationRead], DeviceLocationColumns],
+                description=f"Retrieves Locations inside the given bounding box during the given time window, "
+                            f"restricted to Devices of the authenticated User unless all_devices is set",
+                name=f"Search Locations inside a bounding box")
+    def get_locations_in_bbox(self, min_latitude: float = Query(ge=-90, le=90),
+                              min_longitude: float = Query(ge=-180, le=180),
+                              max_latitude: float = Query(ge=-90, le=90),
+                              max_longitude: float = Query(ge=-180, le=180),
+                              start: Optional[datetime] = None, end: Optional[datetime] = None,
+                              all_devices: bool = False, limit: int = Query(10000, ge=1, le=100000),
+                              layout: Layout = "rows",
+                              others: ImplicitScopeValidator = Depends(
+                                  ImplicitScopeValidator("devices:others:locations")),
+                              _: None = Depends(ScopeValidator("devices:locations:read"))):
+        if min_latitude > max_latitude or min_longitude > max_longitude:
+            raise HTTPException(status_code=400, detail="Minimum bounds must not exceed maximum bounds")
+        if all_devices:
+            others.validate()
+        return columns_response(search_area(self.crud.session, min_latitude, min_longitude, max_latitude,
+                                            max_longitude, start, end, None if all_devices else self.user_id, limit),
+                                layout)
+
+    @router.get("/locations/radius", response_model=Union[list[DeviceLocationRead], DeviceLocationColumns],
+                description=f"Retrieves Locations within radius meters of the given point during the given time "
+                            f"window, restricted to Devices of the authenticated User unless all_devices is set",
+                name=f"Search Locations around a point")
+    def get_locations_in_radius(self, latitude: float = Query(ge=-90, le=90),
+                                longitude: float = Query(ge=-180, le=180), radius: float = Query(gt=0, le=1000000),
+                                start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                all_devices: bool = False, limit: int = Query(10000, ge=1, le=100000),
+                                layout: Layout = "rows",
+                                others: ImplicitScopeValidator = Depends(
+                                    ImplicitScopeValidator("devices:others:locations")),
+                                _: None = Depends(ScopeValidator("devices:locations:read"))):
+        if all_devices:
+            others.validate()
+        return columns_response(search_radius(self.crud.session, latitude, longitude, radius, start, end,
+                                              None if all_devices else self.user_id, limit), layout)
+
+
+@router.post("/locations", response_model=LocationIngestResult, status_code=status.HTTP_200_OK,
+             description="Stores a batch of Locations (JSON array or NDJSON) for the Device owning the given ApiKey",
+             name="Ingest Locations",
+             openapi_extra={"requestBody": {"required": True, "content": {
+                 "application/json": {"schema": {"type": "array", "items": {"type": "object"}}},
+                 "application/x-ndjson": {"schema": {"type": "string"}}}}})
+async def ingest_locations(request: Request, device: DeviceIdentity = Depends(get_device),
+                           crud: GenericCRUD = Depends(router.get_crud)):
+    points, errors = parse_locations(await request.body(), request.headers.get("content-type"))
+    if ingest_buffer.running:
+        # Waiting for the flush must not pin a pooled connection, the flush itself needs one
+        crud.session.close()
+        await ingest_buffer.submit(device, points)
+    else:
+        await run_in_threadpool(write_locations, crud, [(device, points)])
+    return LocationIngestResult(accepted=len(points), rejected=len(errors), errors=errors)
+
+
+@router.get("/apikey/cache", response_model=CacheStats,
+            description="Retrieves hit/miss/eviction counters of the ApiKey resolution cache",
+            name="Retrieve ApiKey cache statistics")
+def get_apikey_cache_stats(_: None = Depends(ScopeValidator("devices:apikey:cache"))):
+    return apikey_cache.stats()
+
+
+def _authorize_live(token: str, device_ids: set[uuid.UUID]) -> None:
+    with Session(engine) as db:
+        user_id, scopes = get_token_scopes(token, db)
+        ScopeValidator("devices:locations:read")(scopes)
+        owners = dict(db.exec(select(Device.id, Device.owner_id).where(Device.id.in_(device_ids))).all())
+    for device_id in device_ids - owners.keys():
+        raise HTTPException(status_code=404, detail=f"Device with id {device_id} not found")
+    if any(owner_id != user_id for owner_id in owners.values()):
+        ImplicitScopeValidator("devices:others:locations", scopes).validate()
+
+
+@router.websocket("/live")
+async def follow_devices_websocket(websocket: WebSocket, token: str, device_id: list[uuid.UUID] = Query()):
+    # Browsers cannot set an Authorization header on WebSockets, so the access token is passed as query parameter
+    try:
+        await run_in_threadpool(_authorize_live, token, set(device_id))
+    except HTTPException as e:
+        raise WebSocketException(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+    await websocket.accept()
+
+    with location_hub.subscribe(set(device_id)) as subscription:
+        async def send():
+            while True:
+                await websocket.send_text(await subscription.get())
+
+        async def receive():
+            # Only needed to notice the disconnect, clients have nothing to say
+            try:
+                while True:
+                    await websocket.receive_text()
+            except WebSocketDisconnect:
+                pass
+
+        tasks = [asyncio.create_task(send()), asyncio.create_task(receive())]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception() is not None and not isinstance(task.exception(), WebSocketDisconnect):
+                raise task.exception()
@@ -0,0 +1,81 @@
+import uuid
+from datetime import datetime
+from typing import Optional
+
+from fastapi import Depends, HTTPException, Query
+from sqlmodel import select
+from typing_extensions import override
+
+from controller.auth import ScopeValidator
+from controller.geofence import geofence_bounds, invalidate_fences, geofence_owner
+from models import Geofence, GeofenceCreate, GeofenceRead, GeofenceUpdate, GeofenceEvent, GeofenceEventRead, Device
+from models.device import to_naive_local
+from models.geofence import GeofenceGeometry
+from utils.crud import GenericCRUD
+from utils.models import ObjectIdentifier
+from utils.router import Models, UniqueNameRouter
+
+geofence_models = Models(base=Geofence, create=GeofenceCreate, read=GeofenceRead, update=GeofenceUpdate)
+
+
+class GeofenceRouter(UniqueNameRouter):
+
+    def __init__(self):
+        super().__init__(geofence_models, tag="geofences", prefix="/geofences")
+
+    @staticmethod
+    def _bounds(geometry: GeofenceGeometry) -> dict:
+        try:
+            return geofence_bounds(geometry)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+    @override
+    async def create_item(self, item: GeofenceCreate, crud: GenericCRUD):
+        bounds = self._bounds(item)
+        if item.device_id:
+            device = await self._run(crud.read, Device, ObjectIdentifier(id=item.device_id))
+            if not device or device.owner_id != item.owner_id:
+                raise HTTPException(status_code=400, detail=f"Device {item.device_id} is not owned by {item.owner_id}")
+        fence = await self._run(crud.create, Geofence, **item.model_dump(), **bounds)
+        invalidate_fences(item.owner_id)
+        return fence
+
+    @override
+    async def update_item(self, obj_id: ObjectIdentifier, item: GeofenceUpdate, crud: GenericCRUD):
+        fence: Geofence = await self._run(crud.read, Geofence, obj_id)
+        # Only None is missing, 0.0 is a valid coordinate and bound
+        values = item.model_dump(exclude_none=True)
+        if not values.get("name"):
+            values.pop("name", None)
+        geometry = GeofenceGeometry.model_validate({field: values.get(field, getattr(fence, field))
+                                                    for field in GeofenceGeometry.model_fields})
+        # Assigned directly, crud.update skips falsy values
+        for key, value in {**values, **self._bounds(geometry)}.items():
+            setattr(fence, key, value)
+        await self._run(crud.refresh, fence)
+        invalidate_fences(fence.owner_id)
+        return fence
+
+    @override
+    async def delete_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        owner_id = await self._run(geofence_owner, crud, obj_id.id)
+        await super().delete_item(obj_id, crud)
+        if owner_id:
+            invalidate_fences(owner_id)
+
+    def extension(self):
+        router = self
+
+        @router.get("/{geofence_id}/events", response_model=list[GeofenceEventRead],
+                    description="Retrieves the enter/exit events recorded for the given Geofence",
+                    name="Retrieve the events of a Geofence")
+        def get_events(geofence_id: uuid.UUID, start: Optional[datetime] = None, end: Optional[datetime] = None,
+                       limit: int = Query(1000, ge=1, le=100000), crud: GenericCRUD = Depends(router.get_crud),
+                       _: None = Depends(ScopeValidator("geofences:read"))):
+            sel = select(GeofenceEvent).where(GeofenceEvent.geofence_id == geofence_id)
+            if start:
+                sel = sel.where(GeofenceEvent.date >= to_naive_local(start))
+            if end:
+                sel = sel.where(GeofenceEvent.date < to_naive_local(end))
+            return crud.session.exec(sel.order_by(GeofenceEvent.date).limit(limit)).all()
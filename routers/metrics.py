@@ -0,0 +1,23 @@
+import os
+import secrets
+from typing import Optional
+
+from fastapi import APIRouter, Header, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from utils.metrics import registry
+
+# Prometheus cannot log in for a short lived JWT, so the endpoint takes an optional static bearer token instead
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+router = APIRouter(tags=["metrics"])
+
+
+@router.get("/metrics", response_class=PlainTextResponse,
+            description="Exposes request latencies, in-flight requests and SQL statement counts in the Prometheus "
+                        "text format",
+            name="Prometheus metrics")
+def metrics(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and not secrets.compare_digest(authorization or "", f"Bearer {METRICS_TOKEN}"):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid metrics token")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
@@ -1,15 +1,51 @@
+import os
 import uuid
+from typing import Optional, Sequence
 
-from fastapi import Depends, HTTPException
+from fastapi import Depends, HTTPException, Response, Query
+from sqlalchemy import func
+from sqlalchemy.orm import selectinload
+from sqlmodel import select, Session
+from typing_extensions import override
 
-from controller.auth import ScopeValidator
+from controller.auth import ScopeValidator, revoke_permissions
 from models import Role, RoleCreate
 from models import UserRead, User
-from models.user import RoleRead
+from models.user import RoleRead, UserRoleLink
+from utils.crud import GenericCRUD
 from utils.models import ObjectIdentifier
-from utils.router import Models, UniqueNameRouter
+from utils.router import Models, UniqueNameRouter, invalidate_responses
 
-role_models = Models(base=Role, create=RoleCreate, read=RoleRead)
+ROLE_USERS_LIMIT = int(os.getenv("ROLE_USERS_LIMIT", 25))
+
+# Role.users is not eagerly loaded as a whole, read_role_users loads a bounded number per Role instead
+role_models = Models(base=Role, create=RoleCreate, read=RoleRead,
+                     loaders=[selectinload(Role.scopes)], batch=True)
+
+
+def read_role_users(session: Session, roles: Sequence[Role], limit: int = ROLE_USERS_LIMIT) -> list[RoleRead]:
+    if not roles:
+        return []
+    # One window query for the whole page: the first users of every Role plus the total per Role
+    ranked = (select(UserRoleLink.role_id, UserRoleLink.user_id,
+                     func.row_number().over(partition_by=UserRoleLink.role_id,
+                                            order_by=UserRoleLink.user_id).label("position"),
+                     func.count().over(partition_by=UserRoleLink.role_id).label("total"))
+              .where(UserRoleLink.role_id.in_([role.id for role in roles]))
+              .subquery())
+    sel = (select(ranked.c.role_id, ranked.c.total, User)
+           .join(User, User.id == ranked.c.user_id)
+           .where(ranked.c.position <= limit)
+           .order_by(ranked.c.role_id, ranked.c.position)
+           .options(selectinload(User.roles)))
+    users: dict[uuid.UUID, list[User]] = {}
+    totals: dict[uuid.UUID, int] = {}
+    for role_id, total, user in session.exec(sel).all():
+        users.setdefault(role_id, []).append(user)
+        totals[role_id] = total
+    return [RoleRead(id=role.id, name=role.name, scopes=role.scopes,
+                     users=[UserRead.model_validate(user) for user in users.get(role.id, [])],
+                     user_count=totals.get(role.id, 0)) for role in roles]
 
 
 class RoleRouter(UniqueNameRouter):
@@ -17,22 +53,79 @@ class RoleRouter(UniqueNameRouter):
     def __init__(self):
         super().__init__(role_models, tag="roles", prefix="/roles")
 
+    @override
+    async def create_item(self, item: RoleCreate, crud: GenericCRUD):
+        role = await super().create_item(item, crud)
+        return (await self._run(read_role_users, crud.session, [role]))[0]
+
+    @override
+    async def get_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        role = await super().get_item(obj_id, crud)
+        return (await self._run(read_role_users, crud.session, [role]))[0] if role else None
+
+    @override
+    async def get_item_by_name(self, name: str, crud: GenericCRUD):
+        role = await super().get_item_by_name(name, crud)
+        return (await self._run(read_role_users, crud.session, [role]))[0] if role else None
+
+    @override
+    async def get_all_items(self, skip: int, limit: int, crud: GenericCRUD, cursor: Optional[str] = None):
+        roles, next_cursor = await super().get_all_items(skip, limit, crud, cursor)
+        return await self._run(read_role_users, crud.session, roles), next_cursor
+
+    @override
+    async def delete_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        holders = select(UserRoleLink.user_id).where(UserRoleLink.role_id == obj_id.id)
+        await self._run(revoke_permissions, crud.session, User.id.in_(holders))
+        await super().delete_item(obj_id, crud)
+
+    @override
+    async def delete_items(self, obj_ids: list[uuid.UUID], crud: GenericCRUD):
+        holders = select(UserRoleLink.user_id).where(UserRoleLink.role_id.in_(obj_ids))
+        await self._run(revoke_permissions, crud.session, User.id.in_(holders))
+        await super().delete_items(obj_ids, crud)
+
     def extension(self):
         router = self
 
+        @router.get("/{role_id}/users", response_model=list[UserRead],
+                    description="Retrieves the Users holding the given Role ordered by id. Passing the X-Next-Cursor "
+                                "header of a page as cursor continues after it",
+                    name="Retrieve the Users of a Role")
+        def get_role_users(role_id: uuid.UUID, response: Response, limit: int = Query(100, ge=1, le=1000),
+                           cursor: Optional[str] = None,
+                           crud: GenericCRUD = Depends(router.get_crud),
+                           _: None = Depends(ScopeValidator("roles:read"))):
+            if not crud.exists(Role, id___is=role_id):
+                raise HTTPException(status_code=404, detail="Role not found")
+
+            def holders(sel):
+                return (sel.join(UserRoleLink, UserRoleLink.user_id == User.id).where(UserRoleLink.role_id == role_id)
+                        .options(selectinload(User.roles)))
+
+            try:
+                users, next_cursor = crud.read_page(User, limit, cursor, restrict=holders)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            if next_cursor:
+                response.headers["X-Next-Cursor"] = next_cursor
+            return users
+
         @router.post("/{user_id}/roles/{role_name}", response_model=UserRead)
-        def assign_role_to_user(role_name: str, user_id: uuid.UUID,
+        def assign_role_to_user(role_name: str, user_id: uuid.UUID, crud: GenericCRUD = Depends(router.get_crud),
                                 _: None = Depends(ScopeValidator("roles:assign"))):
-            user = router.crud.read(Role, ObjectIdentifier(id=user_id), model=User)
+            user = crud.read(User, ObjectIdentifier(id=user_id))
             if not user:
                 raise HTTPException(status_code=404, detail="User not found")
 
-            role = router.crud.read_raw(Role, name___id=role_name)
+            role = crud.read_raw(Role, name___is=role_name)
             if not role:
                 raise HTTPException(status_code=404, detail="Role not found")
 
             if not role in user.roles:
                 user.roles.append(role)
-                router.crud.refresh(user)
+                revoke_permissions(crud.session, User.id == user.id)
+                crud.refresh(user)
+                invalidate_responses(User, Role)
 
             return user
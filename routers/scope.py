@@ -1,9 +1,13 @@
 from fastapi import Depends, HTTPException
+from sqlmodel import select
+from typing_extensions import override
 
-from controller.auth import ScopeValidator
-from models import Role
-from models.user import Scope, ScopeCreate
-from utils.router import Models, UniqueNameRouter
+from controller.auth import ScopeValidator, revoke_permissions
+from models import Role, User
+from models.user import Scope, ScopeCreate, UserRoleLink, RoleScopeLink
+from utils.crud import GenericCRUD
+from utils.models import ObjectIdentifier
+from utils.router import Models, UniqueNameRouter, invalidate_responses
 
 scope_models = Models(base=Scope, create=ScopeCreate, read=Scope)
 
@@ -13,22 +17,33 @@ class ScopeRouter(UniqueNameRouter):
     def __init__(self):
         super().__init__(scope_models, tag="scopes", prefix="/scopes")
 
+    @override
+    async def delete_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        holders = (select(UserRoleLink.user_id)
+                   .join(RoleScopeLink, RoleScopeLink.role_id == UserRoleLink.role_id)
+                   .where(RoleScopeLink.scope_id == obj_id.id))
+        await self._run(revoke_permissions, crud.session, User.id.in_(holders))
+        await super().delete_item(obj_id, crud)
+
     def extension(self):
         router = self
 
         @router.post("/{role_name}/scopes/{scope_name}", response_model=Role)
-        def assign_scope_to_role(role_name: str, scope_name: str,
+        def assign_scope_to_role(role_name: str, scope_name: str, crud: GenericCRUD = Depends(router.get_crud),
                                  _: None = Depends(ScopeValidator("scopes:assign"))):
-            role = router.crud.read_raw(Role, name___is=role_name)
+            role = crud.read_raw(Role, name___is=role_name)
             if not role:
                 raise HTTPException(status_code=404, detail="Role not found")
 
-            scope = router.crud.read_raw(Scope, name___is=scope_name)
+            scope = crud.read_raw(Scope, name___is=scope_name)
             if not scope:
                 raise HTTPException(status_code=404, detail="Scope not found")
 
             if not scope in role.scopes:
-                role.scopes.append(role)
-                router.crud.refresh(role)
+                role.scopes.append(scope)
+                revoke_permissions(crud.session,
+                                   User.id.in_(select(UserRoleLink.user_id).where(UserRoleLink.role_id == role.id)))
+                crud.refresh(role)
+                invalidate_responses(Role, Scope)
 
             return role
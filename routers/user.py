@@ -0,0 +1,54 @@
+import uuid
+
+from typing_extensions import override
+
+from controller.auth import evict_owner_apikeys, revoke_permissions, async_revoke_permissions
+from controller.geofence import invalidate_fences
+from database import async_engine
+from models import User, UserCreate, UserRead, UserUpdate
+from utils.crud import GenericCRUD, AsyncGenericCRUD
+from utils.models import ObjectIdentifier
+from utils.passwords import hash_password
+from utils.router import Models, UniqueNameRouter
+
+user_models = Models(base=User, create=UserCreate, read=UserRead, update=UserUpdate,
+                     crud=AsyncGenericCRUD if async_engine else GenericCRUD, batch=True)
+
+
+class UserRouter(UniqueNameRouter):
+
+    def __init__(self):
+        super().__init__(user_models, tag="users", prefix="/users")
+
+    @override
+    async def prepare_create(self, item: UserCreate) -> dict:
+        return {**await super().prepare_create(item), "password": await hash_password(item.password)}
+
+    @override
+    async def prepare_update(self, item: UserUpdate) -> dict:
+        values = await super().prepare_update(item)
+        if item.password:
+            values["password"] = await hash_password(item.password)
+        return values
+
+    async def _revoke_permissions(self, crud: GenericCRUD, *criteria):
+        if isinstance(crud, AsyncGenericCRUD):
+            await async_revoke_permissions(crud.session, *criteria)
+        else:
+            await self._run(revoke_permissions, crud.session, *criteria)
+
+    @override
+    async def delete_item(self, obj_id: ObjectIdentifier, crud: GenericCRUD):
+        # Committed together with the deletion, stateless tokens of the User stop working like revoked ones
+        await self._revoke_permissions(crud, User.id == obj_id.id)
+        await super().delete_item(obj_id, crud)
+        evict_owner_apikeys(obj_id.id)
+        invalidate_fences(obj_id.id)
+
+    @override
+    async def delete_items(self, obj_ids: list[uuid.UUID], crud: GenericCRUD):
+        await self._revoke_permissions(crud, User.id.in_(obj_ids))
+        await super().delete_items(obj_ids, crud)
+        for obj_id in obj_ids:
+            evict_owner_apikeys(obj_id)
+            invalidate_fences(obj_id)
@@ -1,14 +1,47 @@
-from typing import TypeVar, Generic, Type, Optional, Sequence
+import base64
+import json
+from contextlib import contextmanager, asynccontextmanager
+from typing import TypeVar, Generic, Type, Optional, Sequence, Callable, Mapping, Iterator, AsyncIterator
 
-from sqlalchemy import Select
+from pydantic import TypeAdapter, ValidationError
+from pydantic_core import to_jsonable_python
+from sqlalchemy import Select, insert, tuple_, Insert, or_, update, delete, Delete, inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import RelationshipDirection
+from sqlalchemy.orm.interfaces import ORMOption
 from sqlmodel import Session, SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from utils.models import ObjectIdentifier
 
 T = TypeVar('T', bound=SQLModel)
 
 
-class GenericCRUD(Generic[T]):
+def encode_cursor(values: Sequence) -> str:
+    raw = json.dumps(to_jsonable_python(list(values)), separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(model: Type[T], cursor: str, columns: Sequence[str]) -> list:
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError
+        return [TypeAdapter(model.model_fields[column].annotation).validate_python(value)
+                for column, value in zip(columns, values)]
+    except (ValueError, ValidationError):
+        raise ValueError(f"Invalid cursor '{cursor}'")
+
+
+def dialect_insert(dialect: str, model: Type[T]) -> Insert:
+    if dialect == "postgresql":
+        return postgresql.insert(model)
+    if dialect == "sqlite":
+        return sqlite.insert(model)
+    raise NotImplementedError(f"Upserts are not supported on {dialect}")
+
+
+class BaseCRUD(Generic[T]):
     __FILTERS = {
         "gt": lambda column: column.__gt__,
         "lt": lambda column: column.__lt__,
@@ -17,12 +50,10 @@ class GenericCRUD(Generic[T]):
         "ne": lambda column: column.__ne__,
         "is": lambda column: column.__eq__,
         "is_not": lambda column: column.is_not,
+        "in": lambda column: column.in_,
     }
 
-    def __init__(self, session: Session):
-        self.session = session
-
-    def __create_filter(self, model: Type[T], **kwargs):
+    def _create_filter(self, model: Type[T], **kwargs):
         filters = []
         for k, v in kwargs.items():
             if "___" in k:
@@ -39,23 +70,181 @@ class GenericCRUD(Generic[T]):
                     filters.append(column == v)
         return filters
 
+    @staticmethod
+    def _order_columns(order_by: str) -> list[str]:
+        # The id breaks ties so that the ordering is total
+        return [order_by] if order_by == "id" else [order_by, "id"]
+
+    def _select(self, model: Type[T], columns: Optional[Sequence[str]] = None) -> Select:
+        # Only the given columns as plain rows, skipping the identity map, loader options and model instances
+        if columns:
+            return select(*[getattr(model, name) for name in columns])
+        return select(model).options(*self.options.get(model, ()))
+
+    def _page_select(self, model: Type[T], limit: int, cursor: Optional[str], order_by: str,
+                     columns: Optional[Sequence[str]] = None) -> Select:
+        names = self._order_columns(order_by)
+        order = [getattr(model, name) for name in names]
+        sel: Select = self._select(model, columns).order_by(*order).limit(limit)
+        if cursor:
+            values = decode_cursor(model, cursor, names)
+            sel = sel.where(tuple_(*order) > tuple_(*values) if len(order) > 1 else order[0] > values[0])
+        return sel
+
+    @staticmethod
+    def _group_by_columns(rows: Sequence[dict]) -> list[list[dict]]:
+        # Bulk UPDATE by primary key runs one statement per distinct set of columns
+        groups: dict[frozenset, list[dict]] = {}
+        for row in rows:
+            if len(row) > 1:
+                groups.setdefault(frozenset(row), []).append(row)
+        return list(groups.values())
+
+    @classmethod
+    def _delete_statements(cls, model: type, column, values) -> list[Delete]:
+        # Deletes the rows of model whose column is in values, a list or a subquery, along with the rows its ORM
+        # cascades would delete. Bulk statements, children first, instead of loading and deleting every object
+        statements = []
+        for relationship in inspect(model).relationships:
+            cascaded = relationship.secondary is not None or \
+                (relationship.cascade.delete and relationship.direction is RelationshipDirection.ONETOMANY)
+            if not cascaded:
+                continue
+            for parent, child in relationship.synchronize_pairs:
+                parents = values if parent is column else select(parent).where(column.in_(values))
+                if relationship.secondary is not None:
+                    statements.append(delete(relationship.secondary).where(child.in_(parents)))
+                else:
+                    statements += cls._delete_statements(relationship.mapper.class_, child, parents)
+        statements.append(delete(model).where(column.in_(values)))
+        return statements
+
+    @staticmethod
+    def _upsert_statement(dialect: str, model: Type[T], index_elements: Sequence[str],
+                          set_: Callable[[Insert], dict], where: Optional[Callable[[Insert], object]]) -> Insert:
+        stmt = dialect_insert(dialect, model)
+        return stmt.on_conflict_do_update(index_elements=index_elements, set_=set_(stmt.excluded),
+                                          where=where(stmt.excluded) if where is not None else None)
+
+    def next_cursor(self, items: Sequence[T], limit: int, order_by: str = "id") -> Optional[str]:
+        if not items or len(items) < limit:
+            return None
+        return encode_cursor([getattr(items[-1], name) for name in self._order_columns(order_by)])
+
+
+class GenericCRUD(BaseCRUD[T]):
+
+    def __init__(self, session: Session, options: Mapping[type, Sequence[ORMOption]] = None):
+        self.session = session
+        self.options = options or {}
+        self._depth = 0
+
+    @contextmanager
+    def transaction(self) -> Iterator["GenericCRUD"]:
+        # Inside, the CRUD methods neither commit nor refresh, the outermost block commits once or rolls back
+        # everything; nested blocks are savepoints that roll back on their own
+        if self._depth:
+            savepoint = self.session.begin_nested()
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                savepoint.rollback()
+                raise
+            else:
+                savepoint.commit()
+            finally:
+                self._depth -= 1
+            return
+
+        self._depth = 1
+        try:
+            yield self
+            # Nothing in the models is generated by the database, so the flushed state is kept instead of reloaded
+            expire_on_commit, self.session.expire_on_commit = self.session.expire_on_commit, False
+            try:
+                self.session.commit()
+            finally:
+                self.session.expire_on_commit = expire_on_commit
+        except BaseException:
+            self.session.rollback()
+            raise
+        finally:
+            self._depth = 0
+
+    def _commit(self, *objs: T) -> None:
+        if self._depth:
+            return
+        self.session.commit()
+        for obj in objs:
+            self.session.refresh(obj)
+
     def create(self, model: Type[T], **kwargs) -> T:
         obj = model(**kwargs)
         self.session.add(obj)
-        self.session.commit()
-        self.session.refresh(obj)
+        self._commit(obj)
         return obj
 
+    def create_many(self, model: Type[T], rows: Sequence[dict]) -> None:
+        if rows:
+            self.session.execute(insert(model), rows)
+        self._commit()
+
+    def upsert_many(self, model: Type[T], rows: Sequence[dict], index_elements: Sequence[str],
+                    set_: Callable[[Insert], dict], where: Optional[Callable[[Insert], object]] = None) -> None:
+        if rows:
+            stmt = self._upsert_statement(self.session.get_bind().dialect.name, model, index_elements, set_, where)
+            self.session.execute(stmt, rows)
+        self._commit()
+
+    def upsert(self, model: Type[T], row: dict, index_elements: Sequence[str], set_: Callable[[Insert], dict],
+               where: Optional[Callable[[Insert], object]] = None) -> bool:
+        # Whether the row was written, False when the where clause kept the existing one
+        stmt = self._upsert_statement(self.session.get_bind().dialect.name, model, index_elements, set_, where)
+        written = self.session.execute(stmt.values(row).returning(*inspect(model).primary_key)).first() is not None
+        self._commit()
+        return written
+
+    def insert_missing(self, model: Type[T], row: dict, index_elements: Sequence[str]) -> bool:
+        # Whether the row was inserted, False when one with the same index elements exists
+        stmt = dialect_insert(self.session.get_bind().dialect.name, model)
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        inserted = self.session.execute(stmt.values(row).returning(*inspect(model).primary_key)).first() is not None
+        self._commit()
+        return inserted
+
+    def update_many(self, model: Type[T], rows: Sequence[dict]) -> None:
+        # Every row holds the primary key and the columns to set
+        for group in self._group_by_columns(rows):
+            self.session.execute(update(model), group)
+        self._commit()
+
     def read(self, model: Type[T], obj_id: ObjectIdentifier) -> Optional[T]:
-        return self.session.get(model, obj_id.id)
+        return self.session.get(model, obj_id.id, options=self.options.get(model, ()))
 
     def read_raw(self, model: Type[T], **kwargs) -> Optional[T]:
-        filters = self.__create_filter(model, **kwargs)
-        sel: Select = select(model).filter(*filters).limit(1)
+        filters = self._create_filter(model, **kwargs)
+        sel: Select = select(model).filter(*filters).options(*self.options.get(model, ())).limit(1)
         return self.session.exec(sel).first()
 
-    def read_all(self, model: Type[T], skip: int, limit: int) -> Sequence[T]:
-        return self.session.exec(select(model).offset(skip).limit(limit)).all()
+    def read_any(self, model: Type[T], **kwargs) -> Sequence[T]:
+        # Rows matching at least one of the filters instead of all of them
+        filters = self._create_filter(model, **kwargs)
+        return self.session.exec(select(model).where(or_(*filters))).all() if filters else []
+
+    def read_all(self, model: Type[T], skip: int, limit: int, order_by: str = "id",
+                 columns: Optional[Sequence[str]] = None) -> Sequence[T]:
+        order = [getattr(model, name) for name in self._order_columns(order_by)]
+        sel: Select = self._select(model, columns).order_by(*order).offset(skip).limit(limit)
+        return self.session.exec(sel).all()
+
+    def read_page(self, model: Type[T], limit: int, cursor: Optional[str] = None, order_by: str = "id",
+                  columns: Optional[Sequence[str]] = None,
+                  restrict: Optional[Callable[[Select], Select]] = None) -> tuple[Sequence[T], Optional[str]]:
+        # restrict narrows the page query, e.g. with joins and where clauses
+        sel = self._page_select(model, limit, cursor, order_by, columns)
+        items = self.session.exec(restrict(sel) if restrict else sel).all()
+        return items, self.next_cursor(items, limit, order_by)
 
     def update(self, model: Type[T], obj_id: ObjectIdentifier, **kwargs) -> Optional[T]:
         obj = self.session.get(model, obj_id.id)
@@ -68,34 +257,182 @@ class GenericCRUD(Generic[T]):
             setattr(obj, key, value)
 
         self.session.add(obj)
-        self.session.commit()
-        self.session.refresh(obj)
+        self._commit(obj)
         return obj
 
     def delete(self, model: Type[T], obj_id: ObjectIdentifier) -> None:
-        obj = self.session.get(model, obj_id.id)
-        if obj:
-            self.session.delete(obj)
-            self.session.commit()
+        # Bulk statements like delete_many, the ORM would load every cascaded row, e.g. all Locations of a Device
+        self.delete_many(model, [obj_id.id])
 
-# TODO add transaction rollback support by not commiting directly
     def delete_raw(self, model: Type[T], **kwargs) -> None:
-        filters = self.__create_filter(model, **kwargs)
+        filters = self._create_filter(model, **kwargs)
         sel: Select = select(model).filter(*filters)
         result = self.session.exec(sel).all()
 
         for obj in result:
             self.session.delete(obj)
 
-        self.session.commit()
+        self._commit()
 
+    def delete_many(self, model: Type[T], ids: Sequence) -> None:
+        for statement in self._delete_statements(model, inspect(model).primary_key[0], list(ids)):
+            self.session.execute(statement)
+        self._commit()
 
     def refresh(self, obj: T) -> None:
         self.session.add(obj)
-        self.session.commit()
-        self.session.refresh(obj)
+        self._commit(obj)
 
     def exists(self, model: Type[T], **kwargs) -> bool:
-        filters = self.__create_filter(model, **kwargs)
+        filters = self._create_filter(model, **kwargs)
         sel: Select = select(model).filter(*filters).limit(1)
         return self.session.exec(sel).first() is not None
+
+
+class AsyncGenericCRUD(BaseCRUD[T]):
+
+    def __init__(self, session: AsyncSession, options: Mapping[type, Sequence[ORMOption]] = None):
+        self.session = session
+        self.options = options or {}
+        self._depth = 0
+
+    @asynccontextmanager
+    async def transaction(self) -> AsyncIterator["AsyncGenericCRUD"]:
+        # Same semantics as GenericCRUD.transaction, entered with async with
+        if self._depth:
+            savepoint = await self.session.begin_nested()
+            self._depth += 1
+            try:
+                yield self
+            except BaseException:
+                await savepoint.rollback()
+                raise
+            else:
+                await savepoint.commit()
+            finally:
+                self._depth -= 1
+            return
+
+        self._depth = 1
+        try:
+            yield self
+            await self.session.commit()
+        except BaseException:
+            await self.session.rollback()
+            raise
+        finally:
+            self._depth = 0
+
+    async def _commit(self) -> None:
+        if not self._depth:
+            await self.session.commit()
+
+    async def _load(self, model: Type[T], obj_id) -> Optional[T]:
+        # Relationships cannot be lazy loaded once serialization runs outside the greenlet
+        sel: Select = select(model).where(model.id == obj_id).options(*self.options.get(model, ()))
+        result = await self.session.exec(sel.execution_options(populate_existing=True))
+        return result.first()
+
+    async def create(self, model: Type[T], **kwargs) -> T:
+        obj = model(**kwargs)
+        self.session.add(obj)
+        await self._commit()
+        return await self._load(model, obj.id)
+
+    async def create_many(self, model: Type[T], rows: Sequence[dict]) -> None:
+        if rows:
+            await self.session.execute(insert(model), rows)
+        await self._commit()
+
+    async def upsert_many(self, model: Type[T], rows: Sequence[dict], index_elements: Sequence[str],
+                          set_: Callable[[Insert], dict], where: Optional[Callable[[Insert], object]] = None) -> None:
+        if rows:
+            stmt = self._upsert_statement(self.session.bind.dialect.name, model, index_elements, set_, where)
+            await self.session.execute(stmt, rows)
+        await self._commit()
+
+    async def upsert(self, model: Type[T], row: dict, index_elements: Sequence[str], set_: Callable[[Insert], dict],
+                     where: Optional[Callable[[Insert], object]] = None) -> bool:
+        stmt = self._upsert_statement(self.session.bind.dialect.name, model, index_elements, set_, where)
+        result = await self.session.execute(stmt.values(row).returning(*inspect(model).primary_key))
+        await self._commit()
+        return result.first() is not None
+
+    async def insert_missing(self, model: Type[T], row: dict, index_elements: Sequence[str]) -> bool:
+        stmt = dialect_insert(self.session.bind.dialect.name, model)
+        stmt = stmt.on_conflict_do_nothing(index_elements=index_elements)
+        result = await self.session.execute(stmt.values(row).returning(*inspect(model).primary_key))
+        await self._commit()
+        return result.first() is not None
+
+    async def update_many(self, model: Type[T], rows: Sequence[dict]) -> None:
+        for group in self._group_by_columns(rows):
+            await self.session.execute(update(model), group)
+        await self._commit()
+
+    async def read(self, model: Type[T], obj_id: ObjectIdentifier) -> Optional[T]:
+        return await self._load(model, obj_id.id)
+
+    async def read_raw(self, model: Type[T], **kwargs) -> Optional[T]:
+        filters = self._create_filter(model, **kwargs)
+        sel: Select = select(model).filter(*filters).options(*self.options.get(model, ())).limit(1)
+        return (await self.session.exec(sel)).first()
+
+    async def read_any(self, model: Type[T], **kwargs) -> Sequence[T]:
+        filters = self._create_filter(model, **kwargs)
+        return (await self.session.exec(select(model).where(or_(*filters)))).all() if filters else []
+
+    async def read_all(self, model: Type[T], skip: int, limit: int, order_by: str = "id",
+                       columns: Optional[Sequence[str]] = None) -> Sequence[T]:
+        order = [getattr(model, name) for name in self._order_columns(order_by)]
+        sel: Select = self._select(model, columns).order_by(*order).offset(skip).limit(limit)
+        return (await self.session.exec(sel)).all()
+
+    async def read_page(self, model: Type[T], limit: int, cursor: Optional[str] = None, order_by: str = "id",
+                        columns: Optional[Sequence[str]] = None,
+                        restrict: Optional[Callable[[Select], Select]] = None) -> tuple[Sequence[T], Optional[str]]:
+        sel = self._page_select(model, limit, cursor, order_by, columns)
+        items = (await self.session.exec(restrict(sel) if restrict else sel)).all()
+        return items, self.next_cursor(items, limit, order_by)
+
+    async def update(self, model: Type[T], obj_id: ObjectIdentifier, **kwargs) -> Optional[T]:
+        obj = await self.session.get(model, obj_id.id)
+        if obj is None:
+            return None
+
+        for key, value in kwargs.items():
+            if not value:
+                continue
+            setattr(obj, key, value)
+
+        self.session.add(obj)
+        await self._commit()
+        return await self._load(model, obj.id)
+
+    async def delete(self, model: Type[T], obj_id: ObjectIdentifier) -> None:
+        await self.delete_many(model, [obj_id.id])
+
+    async def delete_raw(self, model: Type[T], **kwargs) -> None:
+        filters = self._create_filter(model, **kwargs)
+        sel: Select = select(model).filter(*filters)
+        result = (await self.session.exec(sel)).all()
+
+        for obj in result:
+            await self.session.delete(obj)
+
+        await self._commit()
+
+    async def delete_many(self, model: Type[T], ids: Sequence) -> None:
+        for statement in self._delete_statements(model, inspect(model).primary_key[0], list(ids)):
+            await self.session.execute(statement)
+        await self._commit()
+
+    async def refresh(self, obj: T) -> None:
+        self.session.add(obj)
+        await self._commit()
+        await self.session.refresh(obj)
+
+    async def exists(self, model: Type[T], **kwargs) -> bool:
+        filters = self._create_filter(model, **kwargs)
+        sel: Select = select(model.id).filter(*filters).limit(1)
+        return (await self.session.exec(sel)).first() is not None
@@ -0,0 +1,86 @@
+import math
+
+import numpy as np
+
+EARTH_RADIUS = 6371008.8
+GEOHASH_ALPHABET = np.array(list("0123456789bcdefghjkmnpqrstuvwxyz"))
+
+
+def _cell_bits(precision: int) -> tuple[int, int]:
+    bits = 5 * precision
+    # Geohash interleaves starting with a longitude bit, so longitude gets the extra bit of odd totals
+    return (bits + 1) // 2, bits // 2
+
+
+def geohash_encode(latitudes: np.ndarray, longitudes: np.ndarray, precision: int) -> np.ndarray:
+    lon_bits, lat_bits = _cell_bits(precision)
+    lat_index = np.clip(((np.asarray(latitudes, dtype=np.float64) + 90) / 180 * (1 << lat_bits)).astype(np.int64),
+                        0, (1 << lat_bits) - 1)
+    lon_index = np.clip(((np.asarray(longitudes, dtype=np.float64) + 180) / 360 * (1 << lon_bits)).astype(np.int64),
+                        0, (1 << lon_bits) - 1)
+
+    code = np.zeros(lat_index.shape, dtype=np.int64)
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            code = (code << 1) | ((lon_index >> (lon_bits - 1 - bit // 2)) & 1)
+        else:
+            code = (code << 1) | ((lat_index >> (lat_bits - 1 - bit // 2)) & 1)
+
+    shifts = np.arange(precision - 1, -1, -1, dtype=np.int64) * 5
+    chars = GEOHASH_ALPHABET[(code[:, None] >> shifts) & 31]
+    return np.array(["".join(row) for row in chars], dtype=object)
+
+
+def geohash_cover(min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float,
+                  max_precision: int, max_cells: int = 32) -> list[str]:
+    # The finest geohash grid that still covers the box with at most max_cells cells
+    for precision in range(max_precision, 0, -1):
+        lon_bits, lat_bits = _cell_bits(precision)
+        height, width = 180 / (1 << lat_bits), 360 / (1 << lon_bits)
+        rows = np.arange(np.floor((min_latitude + 90) / height), np.floor((max_latitude + 90) / height) + 1)
+        columns = np.arange(np.floor((min_longitude + 180) / width), np.floor((max_longitude + 180) / width) + 1)
+        if len(rows) * len(columns) <= max_cells or precision == 1:
+            latitudes = np.clip((rows + 0.5) * height - 90, -90, 90)
+            longitudes = np.clip((columns + 0.5) * width - 180, -180, 180)
+            grid_lat, grid_lon = np.meshgrid(latitudes, longitudes)
+            return sorted(set(geohash_encode(grid_lat.ravel(), grid_lon.ravel(), precision)))
+    return []
+
+
+def haversine(latitudes: np.ndarray, longitudes: np.ndarray, latitude: float, longitude: float) -> np.ndarray:
+    lat1, lon1 = np.radians(latitudes), np.radians(longitudes)
+    lat2, lon2 = np.radians(latitude), np.radians(longitude)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def haversine_distance(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    # Scalar twin of haversine for point by point loops, where NumPy's per call overhead dominates
+    lat1, lat2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((lat2 - lat1) / 2) ** 2
+         + math.cos(lat1) * math.cos(lat2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(min(max(a, 0.0), 1.0)))
+
+
+def radius_bounds(latitude: float, longitude: float, radius: float) -> tuple[float, float, float, float]:
+    delta_lat = float(np.degrees(radius / EARTH_RADIUS))
+    cos_lat = float(np.cos(np.radians(latitude)))
+    delta_lon = 180.0 if cos_lat < 1e-9 else min(180.0, float(np.degrees(radius / (EARTH_RADIUS * cos_lat))))
+    return (max(-90.0, latitude - delta_lat), max(-180.0, longitude - delta_lon),
+            min(90.0, latitude + delta_lat), min(180.0, longitude + delta_lon))
+
+
+def points_in_polygon(latitudes: np.ndarray, longitudes: np.ndarray, vertices: np.ndarray) -> np.ndarray:
+    # Even-odd ray casting, vectorized over the points and looping over the (few) edges
+    inside = np.zeros(len(latitudes), dtype=bool)
+    vertex_lat, vertex_lon = vertices[:, 0], vertices[:, 1]
+    previous = len(vertices) - 1
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for current in range(len(vertices)):
+            lat_a, lat_b = vertex_lat[current], vertex_lat[previous]
+            lon_a, lon_b = vertex_lon[current], vertex_lon[previous]
+            crosses = (lat_a > latitudes) != (lat_b > latitudes)
+            intersection = (lon_b - lon_a) * (latitudes - lat_a) / (lat_b - lat_a) + lon_a
+            inside ^= crosses & (longitudes < intersection)
+            previous = current
+    return inside
@@ -0,0 +1,204 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Optional, Sequence
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Requests slower than this many seconds are logged together with their SQL statements, unset disables the log
+SLOW_REQUEST_THRESHOLD = float(os.getenv("SLOW_REQUEST_THRESHOLD")) if os.getenv("SLOW_REQUEST_THRESHOLD") else None
+SLOW_REQUEST_MAX_STATEMENTS = int(os.getenv("SLOW_REQUEST_MAX_STATEMENTS", 100))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+logger = logging.getLogger("tracker.slow_requests")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    escaped = [str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in values]
+    pairs = [f'{name}="{value}"' for name, value in zip(names, escaped)] + ([extra] if extra else [])
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        return "\n".join([f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}",
+                          *self.samples()])
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(self.label_names, labels)} {_number(value)}" for labels, value in values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        # Per label set: a count per bucket (the last one being +Inf), the sum and the total count
+        self._values: dict[tuple, tuple[list[int], list[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.setdefault(labels, ([0] * (len(self.buckets) + 1), [0.0]))
+            counts[index] += 1
+            total[0] += value
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            values = {labels: (list(counts), total[0]) for labels, (counts, total) in self._values.items()}
+        lines = []
+        for labels, (counts, total) in values.items():
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else _number(bound)
+                bucket = _labels(self.label_names, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics: list[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(metric.render() for metric in self.metrics) + "\n"
+
+
+registry = Registry()
+requests_total = registry.register(Counter("http_requests_total", "Finished HTTP requests",
+                                           ("method", "route", "status")))
+request_duration = registry.register(Histogram("http_request_duration_seconds", "HTTP request latency",
+                                               ("method", "route")))
+requests_in_flight = registry.register(Gauge("http_requests_in_flight", "HTTP requests being served"))
+request_statements = registry.register(Histogram("http_request_sql_statements", "SQL statements per HTTP request",
+                                                 ("method", "route"), buckets=STATEMENT_BUCKETS))
+request_db_duration = registry.register(Histogram("http_request_sql_duration_seconds",
+                                                  "Time spent in SQL statements per HTTP request",
+                                                  ("method", "route")))
+statements_total = registry.register(Counter("sql_statements_total", "SQL statements executed", ("engine",)))
+
+
+@dataclass
+class RequestStats:
+    statements: int = 0
+    db_time: float = 0.0
+    # Only collected while the slow request log is enabled
+    log: Optional[list[tuple[str, float]]] = field(default=None)
+
+
+# Set per request by the middleware; sync routes see it too, as the threadpool runs them in a copy of the context
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def instrument_engine(engine: Engine, name: str) -> None:
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # Kept on the execution context, so statements that fail (and get no after event) leave nothing behind
+        context.metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context.metrics_started
+        statements_total.inc(name)
+        stats = request_stats.get()
+        if stats is not None:
+            stats.statements += 1
+            stats.db_time += elapsed
+            if stats.log is not None and len(stats.log) < SLOW_REQUEST_MAX_STATEMENTS:
+                stats.log.append((statement, elapsed))
+
+
+class MetricsMiddleware:
+    # Plain ASGI instead of BaseHTTPMiddleware, which costs an extra task and memory stream per request
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(log=[] if SLOW_REQUEST_THRESHOLD is not None else None)
+        token = request_stats.set(stats)
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        requests_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            requests_in_flight.dec()
+            request_stats.reset(token)
+            # The route template instead of the path, so ids do not blow up the number of series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            method = scope["method"]
+            requests_total.inc(method, route, str(status_code))
+            request_duration.observe(elapsed, method, route)
+            request_statements.observe(stats.statements, method, route)
+            request_db_duration.observe(stats.db_time, method, route)
+            if SLOW_REQUEST_THRESHOLD is not None and elapsed >= SLOW_REQUEST_THRESHOLD:
+                logger.warning("%s %s -> %d took %.3fs, %d SQL statements in %.3fs:\n%s", method, scope["path"],
+                               status_code, elapsed, stats.statements, stats.db_time,
+                               "\n".join(f"  {duration * 1000:.1f}ms {statement}"
+                                         for statement, duration in stats.log))
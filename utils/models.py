@@ -1,4 +1,5 @@
 import uuid
+from typing import Optional
 
 from sqlmodel import Field, SQLModel
 
@@ -12,3 +13,10 @@ class ObjectIdentifier(SQLModel):
 
 class NamedObject(ObjectIdentifier):
     name: str = Field(max_length=255, unique=True)
+
+
+class BatchItemResult(SQLModel):
+    index: int
+    id: Optional[uuid.UUID] = None
+    status: int
+    detail: Optional[str] = None
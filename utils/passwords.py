@@ -0,0 +1,33 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from passlib.context import CryptContext
+
+PASSWORD_HASH_ROUNDS = int(os.getenv("PASSWORD_HASH_ROUNDS", 12))
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+# Pinning min/max to the configured cost makes verify_and_update report hashes of any other cost as outdated
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=PASSWORD_HASH_ROUNDS,
+                           bcrypt__min_rounds=PASSWORD_HASH_ROUNDS,
+                           bcrypt__max_rounds=PASSWORD_HASH_ROUNDS)
+
+executor = ThreadPoolExecutor(max_workers=PASSWORD_HASH_WORKERS, thread_name_prefix="password")
+
+
+class HashedPassword(str):
+    # Marks a hash made by this module, the User model stores only these as they are. Any other value is hashed, even
+    # if it looks like a hash, so clients can neither plant a precomputed hash nor lock themselves out with one
+    pass
+
+
+async def hash_password(password: str) -> HashedPassword:
+    return HashedPassword(await asyncio.get_running_loop().run_in_executor(executor, pwd_context.hash, password))
+
+
+async def verify_password(password: str, hashed: str) -> tuple[bool, Optional[HashedPassword]]:
+    valid, new_hash = await asyncio.get_running_loop().run_in_executor(executor, pwd_context.verify_and_update,
+                                                                       password, hashed)
+    return valid, HashedPassword(new_hash) if new_hash else None
@@ -1,25 +1,168 @@
+import asyncio
+import hashlib
+import inspect
+import os
+import threading
+import time
+import typing
+import uuid
+from contextlib import contextmanager
 from dataclasses import dataclass
-from typing import Generic, Type, Optional
+from typing import Generic, Type, Optional, Union, Sequence, Awaitable, Callable, Iterator
 
-from fastapi import APIRouter, status, Depends, HTTPException
-from sqlmodel import SQLModel
+from fastapi import APIRouter, status, Depends, HTTPException, Response, Request, Body
+from fastapi.concurrency import run_in_threadpool
+from pydantic import TypeAdapter, create_model
+from sqlalchemy import inspect as sa_inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.interfaces import ORMOption
+from sqlmodel import SQLModel, Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from typing_extensions import TypeVar, override
 
-from controller.auth import ScopeValidator
-from deps import get_session
-from utils.crud import GenericCRUD
-from utils.models import ObjectIdentifier, NamedObject
+from controller.auth import ScopeValidator, AsyncScopeValidator, get_scopes, get_async_scopes
+from deps import get_session, get_async_session
+from utils.cache import TTLCache
+from utils.crud import GenericCRUD, AsyncGenericCRUD
+from utils.models import ObjectIdentifier, NamedObject, BatchItemResult
+from utils.serialization import dumps
+
+# Seconds the generated read routes keep their rendered responses, 0 disables the cache. Entries are dropped by
+# the writes of this process only, other workers may serve them until they expire
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 0))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 1024))
+# By default the ETag of the generated read routes is a hash of the rendered body, exact across workers. A positive
+# value opts single-worker deployments into ETags derived from the generations of this process, valid for that many
+# seconds, so a revalidation is answered with a 304 before anything is loaded. Only with a single worker: the writes
+# of other workers do not change them, and any write of a model changes the tags of all its entities
+RESPONSE_ETAG_TTL = float(os.getenv("RESPONSE_ETAG_TTL", 0))
+# Without the lookup before writes, duplicates are only detected by the unique constraints of the database
+UNIQUE_PRECHECK = os.getenv("UNIQUE_PRECHECK", "true").lower() in ("1", "true", "yes")
+BATCH_MAX_ITEMS = int(os.getenv("BATCH_MAX_ITEMS", 10000))
 
 Model = TypeVar("Model", bound=Optional[ObjectIdentifier])
 Create = TypeVar("Create", bound=Optional[SQLModel])
 Read = TypeVar("Read", bound=Optional[SQLModel])
 Update = TypeVar("Update", bound=Optional[SQLModel])
 Delete = TypeVar("Delete", bound=Optional[ObjectIdentifier])
-CRUD = TypeVar("CRUD", bound=GenericCRUD)
+CRUD = TypeVar("CRUD", bound=Union[GenericCRUD, AsyncGenericCRUD])
 
 NamedModel = TypeVar("NamedModel", bound=NamedObject)
 
 
+def _nested_model(annotation) -> Optional[Type[SQLModel]]:
+    if inspect.isclass(annotation) and issubclass(annotation, SQLModel):
+        return annotation
+    for argument in typing.get_args(annotation):
+        model = _nested_model(argument)
+        if model:
+            return model
+    return None
+
+
+def read_dependencies(base: Type[SQLModel], read: Optional[Type[SQLModel]]) -> frozenset[type]:
+    # The table models whose rows end up in a rendered read model, following its relationships like loader_options
+    models = {base}
+    relationships = base.__sqlmodel_relationships__
+    for name, field in (read.model_fields if read else {}).items():
+        if name in relationships:
+            models |= read_dependencies(getattr(base, name).property.mapper.class_, _nested_model(field.annotation))
+    return frozenset(models)
+
+
+def cascade_dependencies(model: type) -> frozenset[type]:
+    # Deleting a row of model also deletes the rows of these
+    models = {model}
+    for relationship in sa_inspect(model).relationships:
+        if relationship.cascade.delete and relationship.mapper.class_ not in models:
+            models |= cascade_dependencies(relationship.mapper.class_)
+    return frozenset(models)
+
+
+def etag_matches(request: Request, etag: str, loaded: bool = True) -> bool:
+    # "*" only matches an entity that exists, i.e. after it was loaded
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return (loaded and "*" in tags) or etag in tags
+
+
+def not_modified(etag: str) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    etag: str
+    headers: dict[str, str]
+    models: frozenset[type]
+
+    def response(self, request: Request, etag: Optional[str] = None) -> Response:
+        etag = etag or self.etag
+        if etag_matches(request, etag):
+            return not_modified(etag)
+        return Response(self.body, media_type="application/json", headers={"ETag": etag, **self.headers})
+
+
+response_cache: TTLCache[tuple, CachedResponse] = TTLCache(maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# Bumped per model on every invalidation, so a response rendered from rows read before a write is not cached after it
+_generations: dict[type, int] = {}
+_generations_lock = threading.Lock()
+# Part of the generation ETags, the generations of other processes count other writes
+_epoch = uuid.uuid4().hex
+
+
+def _generation(models: frozenset[type]) -> int:
+    with _generations_lock:
+        return sum(_generations.get(model, 0) for model in models)
+
+
+def _generation_etag(key: tuple, generation: int) -> Optional[str]:
+    if RESPONSE_ETAG_TTL <= 0:
+        return None
+    period = int(time.monotonic() // RESPONSE_ETAG_TTL)
+    return f'"{hashlib.blake2b(repr((_epoch, period, generation, key)).encode(), digest_size=16).hexdigest()}"'
+
+
+def invalidate_responses(*models: type) -> None:
+    with _generations_lock:
+        for model in models:
+            _generations[model] = _generations.get(model, 0) + 1
+    response_cache.evict_where(lambda _, cached: not cached.models.isdisjoint(models))
+
+
+def loader_options(base: Type[SQLModel], read: Optional[Type[SQLModel]]) -> list[ORMOption]:
+    # Every relationship the read model serializes is loaded up front, nested read models recursively, so
+    # serialization never lazy loads per row
+    options = []
+    relationships = base.__sqlmodel_relationships__
+    for name, field in (read.model_fields if read else {}).items():
+        if name not in relationships:
+            continue
+        attribute = getattr(base, name)
+        nested = loader_options(attribute.property.mapper.class_, _nested_model(field.annotation))
+        options.append(selectinload(attribute).options(*nested) if nested else selectinload(attribute))
+    return options
+
+
+def read_columns(base: Type[SQLModel], read: Optional[Type[SQLModel]], order_by: str) -> Optional[list[str]]:
+    # The table columns a read model consists of, None if it nests relationships, derives fields or lacks the
+    # columns the pages are ordered by. Lists of such models are rendered from the selected rows directly
+    if not read:
+        return None
+    decorators = read.__pydantic_decorators__
+    if decorators.field_serializers or decorators.model_serializers or read.model_computed_fields:
+        return None
+    names = list(read.model_fields)
+    columns = base.__table__.columns
+    if any(name not in columns or field.serialization_alias for name, field in read.model_fields.items()):
+        return None
+    return names if {order_by, "id"} <= set(names) else None
+
+
 @dataclass
 class Models:
     base: Type[Model]
@@ -28,43 +171,255 @@ class Models:
     update: Type[Update] = None
     delete: Type[Delete] = ObjectIdentifier
     crud: Type[CRUD] = GenericCRUD
+    order_by: str = "id"
+    # Loader options applied whenever base is read, derived from the read model unless given
+    loaders: Optional[Sequence[ORMOption]] = None
+    # Adds /batch routes for the create, update and delete models
+    batch: bool = False
 
 
 class GenericRouter(APIRouter, Generic[Model, Create, Read, Update, Delete, CRUD]):
 
-    def __init__(self, models: Models, tag: str, crud: CRUD = None, prefix: str = ""):
+    def __init__(self, models: Models, tag: str, prefix: str = ""):
         super().__init__(prefix=prefix, tags=[tag])
         self.models = models
         self.tag = tag
-        if not crud:
-            crud = models.crud(session=next(get_session()))
-        self.crud = crud
         self.unique_columns = [column.name for column in models.base.__table__.columns if column.unique]
+        self.loader_options = list(models.loaders) if models.loaders is not None \
+            else loader_options(models.base, models.read)
+        # Authorization runs on the same engine as the CRUD, so a request holds a single connection
+        if issubclass(models.crud, AsyncGenericCRUD):
+            self.get_crud, self.get_scopes, self.scope_validator = \
+                self._get_async_crud, get_async_scopes, AsyncScopeValidator
+        else:
+            self.get_crud, self.get_scopes, self.scope_validator = self._get_sync_crud, get_scopes, ScopeValidator
+        self.read_models = read_dependencies(models.base, models.read)
+        self.read_adapter = TypeAdapter(models.read) if models.read else None
+        self.read_list_adapter = TypeAdapter(list[models.read]) if models.read else None
+        self.read_columns = read_columns(models.base, models.read, models.order_by)
         self.setup()
         self.extension()
 
+    def _get_sync_crud(self, session: Session = Depends(get_session)) -> CRUD:
+        return self.models.crud(session=session, options={self.models.base: self.loader_options})
+
+    def _get_async_crud(self, session: AsyncSession = Depends(get_async_session)) -> CRUD:
+        return self.models.crud(session=session, options={self.models.base: self.loader_options})
+
+    @staticmethod
+    async def _run(func, *args, **kwargs):
+        # Sync CRUD calls block, so they are moved off the event loop
+        if inspect.iscoroutinefunction(func):
+            return await func(*args, **kwargs)
+        return await run_in_threadpool(func, *args, **kwargs)
+
+    def render_item(self, content) -> bytes:
+        return self.read_adapter.dump_json(self.read_adapter.validate_python(content, from_attributes=True))
+
+    def render_items(self, content) -> bytes:
+        if self.read_columns:
+            # Rows of exactly the read model's columns, nothing to validate
+            return dumps([row._asdict() for row in content])
+        return self.read_list_adapter.dump_json(self.read_list_adapter.validate_python(content, from_attributes=True))
+
+    async def _cached_read(self, request: Request, scopes: set[str], render: Callable[[object], bytes],
+                           load: Callable[[], Awaitable[tuple[object, dict[str, str]]]]) -> Response:
+        # Rendered here instead of by FastAPI, so repeated polls are answered from the cache, and with a 304 without
+        # loading anything if the client has the current version already
+        key = (request.scope["route"].path, tuple(sorted(request.path_params.items())),
+               tuple(sorted(request.query_params.multi_items())), tuple(sorted(scopes)))
+        generation = _generation(self.read_models)
+        etag = _generation_etag(key, generation)
+        if etag and etag_matches(request, etag, loaded=False):
+            return not_modified(etag)
+        cached = response_cache.get(key) if RESPONSE_CACHE_TTL > 0 else None
+        if cached is None:
+            content, headers = await load()
+            body = render(content)
+            cached = CachedResponse(body=body, etag=etag or f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"',
+                                    headers=headers, models=self.read_models)
+            if RESPONSE_CACHE_TTL > 0 and _generation(self.read_models) == generation:
+                response_cache.set(key, cached)
+        return cached.response(request, etag)
+
+    async def prepare_create(self, item: Create) -> dict:
+        # The column values for a new row. Batches prepare their items concurrently, so no session is passed
+        return item.model_dump()
+
+    async def prepare_update(self, item: Update) -> dict:
+        return item.model_dump(exclude={"id"})
+
     async def create_item(self, item: Create, crud: CRUD):
-        return crud.create(self.models.base, **item.model_dump())
+        return await self._run(crud.create, self.models.base, **await self.prepare_create(item))
 
     async def get_item(self, obj_id: ObjectIdentifier, crud: CRUD):
-        return crud.read(self.models.base, obj_id)
+        return await self._run(crud.read, self.models.base, obj_id)
+
+    async def get_item_by_name(self, name: str, crud: CRUD):
+        return await self._run(crud.read_raw, self.models.base, name___is=name)
 
-    async def get_all_items(self, skip: int, limit: int, crud: CRUD):
-        return crud.read_all(self.models.base, skip=skip, limit=limit)
+    async def get_all_items(self, skip: int, limit: int, crud: CRUD, cursor: Optional[str] = None):
+        if cursor is not None:
+            try:
+                return await self._run(crud.read_page, self.models.base, limit=limit, cursor=cursor,
+                                       order_by=self.models.order_by, columns=self.read_columns)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+        items = await self._run(crud.read_all, self.models.base, skip=skip, limit=limit,
+                                order_by=self.models.order_by, columns=self.read_columns)
+        return items, crud.next_cursor(items, limit, self.models.order_by)
 
     async def update_item(self, obj_id: ObjectIdentifier, item: Update, crud: CRUD):
-        return crud.update(self.models.base, obj_id, **item.model_dump())
+        return await self._run(crud.update, self.models.base, obj_id, **await self.prepare_update(item))
 
     async def delete_item(self, obj_id: ObjectIdentifier, crud: CRUD):
-        crud.delete(self.models.base, obj_id)
+        await self._run(crud.delete, self.models.base, obj_id)
+
+    async def delete_items(self, obj_ids: list[uuid.UUID], crud: CRUD):
+        await self._run(crud.delete_many, self.models.base, obj_ids)
+
+    async def _batch_conflicts(self, items: dict[int, object], obj_ids: dict[int, uuid.UUID],
+                               crud: CRUD) -> dict[int, str]:
+        # One lookup for the unique values of the items that would be written, by their index in the batch. Values
+        # repeated among them conflict as well, obj_ids holds the rows updated by them
+        conflicts: dict[int, str] = {}
+        first: dict[tuple[str, object], int] = {}
+        for index, item in items.items():
+            for column, value in self._unique_values(item).items():
+                if first.setdefault((column, value), index) != index:
+                    conflicts.setdefault(index, f"Value '{column}={value}' is already in use")
+        filters = {}
+        for column, value in first:
+            filters.setdefault(f"{column}___in", []).append(value)
+        for row in (await self._run(crud.read_any, self.models.base, **filters) if filters else []):
+            for column in self.unique_columns:
+                index = first.get((column, getattr(row, column)))
+                if index is not None and obj_ids.get(index) != row.id:
+                    conflicts.setdefault(index, f"Value '{column}={getattr(row, column)}' is already in use")
+        return conflicts
+
+    @staticmethod
+    def _check_batch_size(items: Sequence) -> None:
+        if len(items) > BATCH_MAX_ITEMS:
+            raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_ITEMS} items per batch")
+
+    @staticmethod
+    async def _prepare_batch(prepare, items: dict[int, object],
+                             results: list[Optional[BatchItemResult]]) -> dict[int, dict]:
+        prepared = await asyncio.gather(*(prepare(item) for item in items.values()), return_exceptions=True)
+        values = {}
+        for index, value in zip(items, prepared):
+            if isinstance(value, HTTPException):
+                results[index] = BatchItemResult(index=index, status=value.status_code, detail=str(value.detail))
+            elif isinstance(value, BaseException):
+                raise value
+            else:
+                values[index] = value
+        return values
+
+    async def create_batch(self, items: Sequence[Create], crud: CRUD, **values) -> list[BatchItemResult]:
+        # Items failing their checks are reported and skipped, all others are inserted by a single statement.
+        # values are set on every item, e.g. an owner
+        self._check_batch_size(items)
+        results: list[Optional[BatchItemResult]] = [None] * len(items)
+        conflicts = await self._batch_conflicts(dict(enumerate(items)), {}, crud)
+        for index, detail in conflicts.items():
+            results[index] = BatchItemResult(index=index, status=400, detail=detail)
+        prepared = await self._prepare_batch(self.prepare_create, {index: item for index, item in enumerate(items)
+                                                                   if index not in conflicts}, results)
+        rows = []
+        for index, row in prepared.items():
+            # Built through the model for its defaults, e.g. the id
+            row = self.models.base(**row, **values).model_dump()
+            rows.append(row)
+            results[index] = BatchItemResult(index=index, id=row["id"], status=status.HTTP_201_CREATED)
+        with self.unique_violations(None):
+            await self._run(crud.create_many, self.models.base, rows)
+        invalidate_responses(self.models.base)
+        return results
+
+    async def update_batch(self, items: Sequence, crud: CRUD) -> list[BatchItemResult]:
+        self._check_batch_size(items)
+        results: list[Optional[BatchItemResult]] = [None] * len(items)
+        ids = [item.id for item in items]
+        found = {row.id for row in await self._run(crud.read_any, self.models.base, id___in=list(set(ids)))}
+        candidates = {}
+        seen = set()
+        for index, item in enumerate(items):
+            if item.id not in found:
+                results[index] = BatchItemResult(index=index, id=item.id, status=404, detail=f"'{item.id}' not found")
+            elif item.id in seen:
+                results[index] = BatchItemResult(index=index, id=item.id, status=400,
+                                                 detail=f"'{item.id}' is repeated in the batch")
+            else:
+                candidates[index] = item
+            seen.add(item.id)
+        # Only items that will be written can make another one conflict
+        conflicts = await self._batch_conflicts(candidates, {index: ids[index] for index in candidates}, crud)
+        pending = {}
+        for index, item in candidates.items():
+            if index in conflicts:
+                results[index] = BatchItemResult(index=index, id=item.id, status=400, detail=conflicts[index])
+            else:
+                pending[index] = item
+        prepared = await self._prepare_batch(self.prepare_update, pending, results)
+        rows = []
+        for index, row in prepared.items():
+            # Like GenericCRUD.update, empty values are left untouched
+            rows.append({"id": ids[index], **{key: value for key, value in row.items() if value}})
+            results[index] = BatchItemResult(index=index, id=ids[index], status=status.HTTP_200_OK)
+        with self.unique_violations(None):
+            await self._run(crud.update_many, self.models.base, rows)
+        invalidate_responses(self.models.base)
+        return results
+
+    async def delete_batch(self, obj_ids: Sequence[uuid.UUID], crud: CRUD) -> list[BatchItemResult]:
+        self._check_batch_size(obj_ids)
+        found = {row.id for row in await self._run(crud.read_any, self.models.base, id___in=list(set(obj_ids)))}
+        if found:
+            await self.delete_items(list(found), crud)
+            invalidate_responses(*cascade_dependencies(self.models.base))
+        return [BatchItemResult(index=index, id=obj_id, status=status.HTTP_204_NO_CONTENT) if obj_id in found
+                else BatchItemResult(index=index, id=obj_id, status=404, detail=f"'{obj_id}' not found")
+                for index, obj_id in enumerate(obj_ids)]
+
+    def _unique_values(self, obj) -> dict:
+        return {column: getattr(obj, column) for column in self.unique_columns
+                if getattr(obj, column, None) is not None}
+
+    def _check_conflicts(self, values: dict, conflicts: Sequence[Model], obj_id: Optional[ObjectIdentifier]) -> None:
+        for column, value in values.items():
+            if any(getattr(row, column) == value and (not obj_id or row.id != obj_id.id) for row in conflicts):
+                raise HTTPException(status_code=400, detail=f"Value '{column}={value}' is already in use")
+
+    async def _validate_uniques(self, obj, crud: CRUD, obj_id: ObjectIdentifier = None):
+        # One lookup for all unique columns together
+        values = self._unique_values(obj)
+        if UNIQUE_PRECHECK and values:
+            self._check_conflicts(values, await self._run(crud.read_any, self.models.base, **values), obj_id)
+
+    def validate_uniques(self, obj, crud: GenericCRUD, obj_id: ObjectIdentifier = None):
+        # For sync routes added by extensions
+        values = self._unique_values(obj)
+        if UNIQUE_PRECHECK and values:
+            self._check_conflicts(values, crud.read_any(self.models.base, **values), obj_id)
 
-    def _validate_uniques(self, obj, obj_id: ObjectIdentifier = None):
-        for column in self.unique_columns:
-            if hasattr(obj, column):
-                value = getattr(obj, column)
-                model_obj = self.crud.read_raw(self.models.base, **{column: value})
-                if model_obj and (not obj_id or model_obj.id != obj_id.id):
-                    raise HTTPException(status_code=400, detail=f"Value '{column}={value}' is already in use")
+    @contextmanager
+    def unique_violations(self, obj) -> Iterator[None]:
+        # Duplicates inserted concurrently after the lookup, or without it, get the same 400 as the lookup. Batches
+        # pass no obj, they only learn that nothing was stored
+        try:
+            yield
+        except IntegrityError as e:
+            message = str(e.orig)
+            table = self.models.base.__tablename__
+            for column in self.unique_columns:
+                # SQLite and PostgreSQL respectively
+                if f"{table}.{column}" in message or f"Key ({column})=" in message:
+                    detail = f"Value '{column}={getattr(obj, column)}' is already in use" if obj is not None \
+                        else f"A value of {column} was taken concurrently, nothing was stored"
+                    raise HTTPException(status_code=400, detail=detail) from e
+            raise
 
     def extension(self):
         pass
@@ -72,71 +427,119 @@ class GenericRouter(APIRouter, Generic[Model, Create, Read, Update, Delete, CRUD
     def setup(self):
         models = self.models
         tag = self.tag
-        crud = self.crud
+
+        # Registered first, the /{id} routes would match /batch otherwise
+        if models.create and models.batch:
+            @self.post("/batch", response_model=list[BatchItemResult], status_code=status.HTTP_200_OK,
+                       description=f"Creates up to {BATCH_MAX_ITEMS} {models.base.__name__} entities in a single "
+                                   f"transaction, reporting a status per item",
+                       name=f"Create {models.base.__name__} entities in bulk")
+            async def create_batch_route(items: list[models.create] = Body(), crud: CRUD = Depends(self.get_crud),
+                                         _: None = Depends(self.scope_validator(f"{tag}:create"))):
+                return await self.create_batch(items, crud)
+
+        if models.update and models.batch:
+            batch_update = create_model(f"{models.update.__name__}Batch", __base__=models.update, id=(uuid.UUID, ...))
+
+            @self.patch("/batch", response_model=list[BatchItemResult],
+                        description=f"Patches up to {BATCH_MAX_ITEMS} {models.base.__name__} entities, identified by "
+                                    f"their id, in a single transaction, reporting a status per item",
+                        name=f"Patch {models.base.__name__} entities in bulk")
+            async def patch_batch_route(items: list[batch_update] = Body(), crud: CRUD = Depends(self.get_crud),
+                                        _: None = Depends(self.scope_validator(f"{tag}:update"))):
+                return await self.update_batch(items, crud)
+
+        if models.delete and models.batch:
+            @self.delete("/batch", response_model=list[BatchItemResult],
+                         description=f"Deletes up to {BATCH_MAX_ITEMS} {models.base.__name__} entities by id in a "
+                                     f"single transaction, reporting a status per item",
+                         name=f"Delete {models.base.__name__} entities in bulk")
+            async def delete_batch_route(ids: list[uuid.UUID] = Body(), crud: CRUD = Depends(self.get_crud),
+                                         _: None = Depends(self.scope_validator(f"{tag}:delete"))):
+                return await self.delete_batch(ids, crud)
 
         if models.create:
             @self.post("/", response_model=models.read, status_code=status.HTTP_201_CREATED,
                        description=f"Creates a new {models.base.__name__} using {models.create.__name__}",
                        name=f"Create a new {models.base.__name__}")
-            async def create_route(create_obj: models.create = Depends(),
-                                   _: None = Depends(ScopeValidator(f"{tag}:create"))) -> Read:
-                self._validate_uniques(create_obj)
-                return await self.create_item(create_obj, crud)
+            async def create_route(create_obj: models.create = Depends(), crud: CRUD = Depends(self.get_crud),
+                                   _: None = Depends(self.scope_validator(f"{tag}:create"))) -> Read:
+                await self._validate_uniques(create_obj, crud)
+                with self.unique_violations(create_obj):
+                    obj = await self.create_item(create_obj, crud)
+                invalidate_responses(models.base)
+                return obj
 
         if models.read:
             @self.get("/id/{id}", response_model=models.read, status_code=status.HTTP_200_OK,
                       description=f"Retrieves an existing {models.base.__name__} by its id",
                       name=f"Retrieve a {models.base.__name__}")
-            async def get_route(id: ObjectIdentifier = Depends(),
-                                _: None = Depends(ScopeValidator(f"{tag}:read"))):
-                obj = await self.get_item(id, crud)
-                if not obj:
-                    raise HTTPException(status_code=404, detail=f"'{id}' not found")
-                return obj
+            async def get_route(request: Request, id: ObjectIdentifier = Depends(), crud: CRUD = Depends(self.get_crud),
+                                scopes: set[str] = Depends(self.get_scopes),
+                                _: None = Depends(self.scope_validator(f"{tag}:read"))):
+                async def load():
+                    obj = await self.get_item(id, crud)
+                    if not obj:
+                        raise HTTPException(status_code=404, detail=f"'{id}' not found")
+                    return obj, {}
+
+                return await self._cached_read(request, scopes, self.render_item, load)
 
         if models.read:
             @self.get("/", response_model=list[models.read],
-                      description=f"Retrieves all existing {models.base.__name__} entities",
+                      description=f"Retrieves all existing {models.base.__name__} entities. Passing the "
+                                  f"X-Next-Cursor header of a page as cursor continues after it in constant time, "
+                                  f"skip is the offset based fallback",
                       name=f"Retrieve all {models.base.__name__} entities")
-            async def get_all_route(_: None = Depends(ScopeValidator(f"{tag}:read")),
-                                    skip: int = 0, limit: int = 10):
-                return await self.get_all_items(skip, limit, crud)
+            async def get_all_route(request: Request, _: None = Depends(self.scope_validator(f"{tag}:read")),
+                                    crud: CRUD = Depends(self.get_crud), scopes: set[str] = Depends(self.get_scopes),
+                                    skip: int = 0, limit: int = 10, cursor: Optional[str] = None):
+                async def load():
+                    items, next_cursor = await self.get_all_items(skip, limit, crud, cursor)
+                    return items, {"X-Next-Cursor": next_cursor} if next_cursor else {}
+
+                return await self._cached_read(request, scopes, self.render_items, load)
 
         if models.update:
             @self.patch("/{id}", response_model=models.read,
                         description=f"Patches an existing {models.base.__name__} by attributes",
                         name=f"Patch a {models.base.__name__}")
             async def patch_route(opt_type: models.update = Depends(), id: ObjectIdentifier = Depends(),
-                                  _: None = Depends(ScopeValidator(f"{tag}:update"))):
-                if not crud.exists(models.base, id___is=id.id):
+                                  crud: CRUD = Depends(self.get_crud),
+                                  _: None = Depends(self.scope_validator(f"{tag}:update"))):
+                if not await self._run(crud.exists, models.base, id___is=id.id):
                     raise HTTPException(status_code=404, detail=f"'{id}' not found")
-                self._validate_uniques(opt_type, id)
-                return await self.update_item(id, opt_type, crud)
+                await self._validate_uniques(opt_type, crud, id)
+                with self.unique_violations(opt_type):
+                    obj = await self.update_item(id, opt_type, crud)
+                invalidate_responses(models.base)
+                return obj
 
             @self.put("/{id}", response_model=models.read,
                       description=f"Updates an existing {models.base.__name__}",
                       name=f"Update a {models.base.__name__}")
             async def update_route(update_obj: models.update = Depends(), id: ObjectIdentifier = Depends(),
-                                   _: None = Depends(ScopeValidator(f"{tag}:update"))):
+                                   crud: CRUD = Depends(self.get_crud),
+                                   _: None = Depends(self.scope_validator(f"{tag}:update"))):
                 if not all(update_obj.model_dump().values()):
                     raise HTTPException(status_code=400, detail="Not all attributes were given")
-                return await patch_route(update_obj, id)
+                return await patch_route(update_obj, id, crud)
 
         if models.delete:
             @self.delete("/{id}", status_code=status.HTTP_204_NO_CONTENT,
                          description=f"Deletes an existing {models.base.__name__}",
                          name=f"Delete a {models.base.__name__}")
-            async def delete_route(id: models.delete = Depends(),
-                                   _: None = Depends(ScopeValidator(f"{tag}:delete"))):
-                if not crud.read(self.models.base, id):
+            async def delete_route(id: models.delete = Depends(), crud: CRUD = Depends(self.get_crud),
+                                   _: None = Depends(self.scope_validator(f"{tag}:delete"))):
+                if not await self._run(crud.read, self.models.base, id):
                     raise HTTPException(status_code=404, detail=f"'{id}' not found")
-                return await self.delete_item(id, crud)
+                await self.delete_item(id, crud)
+                invalidate_responses(*cascade_dependencies(models.base))
 
 
-class UniqueNameRouter(GenericRouter[NamedModel, Create, Read, Update, Delete, GenericCRUD]):
-    def __init__(self, models: Models, tag: str, crud: CRUD = None,
-                 prefix: str = ""):
-        super().__init__(models, tag, crud, prefix)
+class UniqueNameRouter(GenericRouter[NamedModel, Create, Read, Update, Delete, CRUD]):
+    def __init__(self, models: Models, tag: str, prefix: str = ""):
+        super().__init__(models, tag, prefix)
         if not issubclass(models.base, NamedObject):
             raise ValueError("Only named objects are supported")
 
@@ -149,18 +552,25 @@ class UniqueNameRouter(GenericRouter[NamedModel, Create, Read, Update, Delete, G
             @router.get("/name/{name}", response_model=router.models.read,
                         description=f"Retrieves an existing {router.models.base.__name__} by its name",
                         name=f"Retrieve a {router.models.base.__name__}")
-            async def get_by_name_route(name: str, _: None = Depends(ScopeValidator(f"{router.tag}:read"))):
-                obj = router.crud.read_raw(self.models.base, name___is=name)
-                if not obj:
-                    raise HTTPException(status_code=404, detail=f"{name} not found")
-                return obj
+            async def get_by_name_route(request: Request, name: str, crud: CRUD = Depends(router.get_crud),
+                                        scopes: set[str] = Depends(router.get_scopes),
+                                        _: None = Depends(router.scope_validator(f"{router.tag}:read"))):
+                async def load():
+                    obj = await router.get_item_by_name(name, crud)
+                    if not obj:
+                        raise HTTPException(status_code=404, detail=f"{name} not found")
+                    return obj, {}
+
+                return await router._cached_read(request, scopes, router.render_item, load)
 
         if self.models.delete:
             @router.delete("/name/{name}", status_code=status.HTTP_204_NO_CONTENT,
                            description=f"Deletes an existing {router.models.base.__name__} by its name",
                            name=f"Delete a {router.models.base.__name__}")
-            async def delete_by_name_route(name: str, _: None = Depends(ScopeValidator(f"{router.tag}:delete"))):
-                obj = router.crud.read_raw(self.models.base, name___is=name)
+            async def delete_by_name_route(name: str, crud: CRUD = Depends(router.get_crud),
+                                           _: None = Depends(router.scope_validator(f"{router.tag}:delete"))):
+                obj = await router._run(crud.read_raw, self.models.base, name___is=name)
                 if not obj:
                     raise HTTPException(status_code=404, detail=f"{name} not found")
-                router.crud.delete(self.models.base, ObjectIdentifier(id=obj.id))
+                await router.delete_item(ObjectIdentifier(id=obj.id), crud)
+                invalidate_responses(*cascade_dependencies(router.models.base))
@@ -0,0 +1,80 @@
+import numpy as np
+
+SEGMENT_MAGIC = b"TSEG"
+SEGMENT_VERSION = 1
+# Coordinates are stored as integer multiples of 1e-7 degrees, about 1cm at the equator
+COORDINATE_SCALE = 10 ** 7
+SEGMENT_HEADER = np.dtype([("magic", "S4"), ("version", "<u2"), ("count", "<u4"), ("lengths", "<u4", (3,))])
+
+
+def zigzag_encode(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.int64)
+    return ((values << 1) ^ (values >> 63)).view(np.uint64)
+
+
+def zigzag_decode(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.uint64)
+    return (values >> np.uint64(1)).view(np.int64) ^ -(values & np.uint64(1)).view(np.int64)
+
+
+def varint_encode(values: np.ndarray) -> np.ndarray:
+    values = np.asarray(values, dtype=np.uint64)
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        lengths += values >= np.uint64(1 << shift)
+    ends = np.cumsum(lengths)
+    owners = np.repeat(np.arange(len(values)), lengths)
+    positions = np.arange(int(ends[-1]) if len(values) else 0) - np.repeat(ends - lengths, lengths)
+    encoded = ((values[owners] >> (7 * positions).astype(np.uint64)) & np.uint64(0x7f)).astype(np.uint8)
+    # The high bit marks every byte but the last one of a value
+    encoded[positions < lengths[owners] - 1] |= 0x80
+    return encoded
+
+
+def varint_decode(data: np.ndarray) -> np.ndarray:
+    data = np.asarray(data, dtype=np.uint8)
+    if not len(data):
+        return np.array([], dtype=np.uint64)
+    last = (data & 0x80) == 0
+    starts = np.r_[0, np.flatnonzero(last)[:-1] + 1]
+    owners = np.r_[0, np.cumsum(last[:-1])]
+    positions = np.arange(len(data)) - starts[owners]
+    parts = (data & 0x7f).astype(np.uint64) << (7 * positions).astype(np.uint64)
+    # The 7 bit groups of a value never overlap, so summing them is the same as or-ing them
+    return np.add.reduceat(parts, starts)
+
+
+def _encode_column(values: np.ndarray) -> np.ndarray:
+    return varint_encode(zigzag_encode(np.diff(values, prepend=0)))
+
+
+def _decode_column(data: np.ndarray) -> np.ndarray:
+    return np.cumsum(zigzag_decode(varint_decode(data)))
+
+
+def encode_segment(ticks: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray) -> bytes:
+    # Sorted by time, exact duplicates (e.g. from an interrupted compaction) are dropped
+    rows = np.unique(np.stack([np.asarray(ticks, dtype=np.int64),
+                               np.round(np.asarray(latitudes) * COORDINATE_SCALE).astype(np.int64),
+                               np.round(np.asarray(longitudes) * COORDINATE_SCALE).astype(np.int64)], axis=1), axis=0)
+    columns = [_encode_column(rows[:, column]) for column in range(3)]
+    header = np.zeros(1, dtype=SEGMENT_HEADER)
+    header["magic"], header["version"], header["count"] = SEGMENT_MAGIC, SEGMENT_VERSION, len(rows)
+    header["lengths"] = [len(column) for column in columns]
+    return header.tobytes() + b"".join(column.tobytes() for column in columns)
+
+
+def decode_segment(data: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    header = np.frombuffer(data[:SEGMENT_HEADER.itemsize], dtype=SEGMENT_HEADER)[0]
+    if header["magic"] != SEGMENT_MAGIC or header["version"] != SEGMENT_VERSION:
+        raise ValueError("Not a location segment")
+    offsets = np.r_[0, np.cumsum(header["lengths"])] + SEGMENT_HEADER.itemsize
+    ticks, latitudes, longitudes = (_decode_column(data[offsets[column]:offsets[column + 1]]) for column in range(3))
+    if len(ticks) != header["count"]:
+        raise ValueError("Truncated location segment")
+    return ticks, latitudes / COORDINATE_SCALE, longitudes / COORDINATE_SCALE
+
+
+def read_segment(path: str) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Mapped instead of read, the page cache is shared by all workers reading the same segment
+    return decode_segment(np.memmap(path, dtype=np.uint8, mode="r"))
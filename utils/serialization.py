@@ -0,0 +1,51 @@
+import datetime
+import json
+import uuid
+from typing import Literal, Sequence, Mapping
+
+import numpy as np
+from fastapi import Response
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# rows is the usual list of objects, columns one array per field, e.g. {"date": [...], "latitude": [...]}
+Layout = Literal["rows", "columns"]
+
+
+def _default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content) -> bytes:
+    # orjson encodes datetimes, UUIDs and numpy arrays natively, the standard library is the fallback when it is
+    # not installed
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(content, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def to_rows(columns: Mapping[str, Sequence]) -> list[dict]:
+    names = list(columns)
+    values = [column.tolist() if isinstance(column, np.ndarray) else column for column in columns.values()]
+    return [dict(zip(names, row)) for row in zip(*values)]
+
+
+class FastJSONResponse(Response):
+    # Skips the response_model validation and jsonable_encoder, the content has to be plain already
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return dumps(content)
+
+
+def columns_response(columns: Mapping[str, Sequence], layout: Layout = "rows") -> FastJSONResponse:
+    return FastJSONResponse(columns if layout == "columns" else to_rows(columns))
@@ -0,0 +1,74 @@
+import heapq
+
+import numpy as np
+
+# Douglas-Peucker scans its input once per split, so longer tracks are bucketed to this multiple first
+SIMPLIFY_PREBUCKET_FACTOR = 8
+
+
+def bucket_indices(times: np.ndarray, max_points: int) -> np.ndarray:
+    count = len(times)
+    if count <= max_points:
+        return np.arange(count)
+    if max_points < 2:
+        return np.array([count - 1])
+
+    ticks = times.astype("datetime64[us]").astype(np.int64) if times.dtype.kind == "M" else times
+    edges = np.linspace(ticks[0], ticks[-1], max_points)
+    buckets = np.searchsorted(edges, ticks, side="right") - 1
+    # The first point of each non empty time bucket, plus the final point of the track
+    firsts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    return np.unique(np.r_[firsts[:max_points - 1], count - 1])
+
+
+def _farthest(x: np.ndarray, y: np.ndarray, start: int, end: int) -> tuple[int, float]:
+    px = x[start + 1:end] - x[start]
+    py = y[start + 1:end] - y[start]
+    dx = x[end] - x[start]
+    dy = y[end] - y[start]
+    norm = np.hypot(dx, dy)
+    if norm == 0:
+        distances = np.hypot(px, py)
+    else:
+        distances = np.abs(dy * px - dx * py) / norm
+    index = int(np.argmax(distances))
+    return start + 1 + index, float(distances[index])
+
+
+def simplify_indices(latitudes: np.ndarray, longitudes: np.ndarray, max_points: int) -> np.ndarray:
+    count = len(latitudes)
+    if count <= max_points:
+        return np.arange(count)
+    if max_points < 2:
+        return np.array([count - 1])
+
+    # Equirectangular projection is accurate enough for ranking deviations of a single track
+    y = latitudes
+    x = longitudes * np.cos(np.radians(np.mean(latitudes)))
+
+    # Douglas-Peucker ranked by deviation: always split the segment with the largest error next,
+    # which stops exactly at max_points instead of at a tolerance that has to be guessed
+    keep = [0, count - 1]
+    segments: list[tuple[float, int, int, int]] = []
+
+    def push(start: int, end: int):
+        if end - start > 1:
+            index, error = _farthest(x, y, start, end)
+            heapq.heappush(segments, (-error, start, end, index))
+
+    push(0, count - 1)
+    while segments and len(keep) < max_points:
+        _, start, end, index = heapq.heappop(segments)
+        keep.append(index)
+        push(start, index)
+        push(index, end)
+    return np.sort(np.array(keep))
+
+
+def downsample_indices(times: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray, max_points: int,
+                       method: str = "simplify") -> np.ndarray:
+    if method == "bucket":
+        return bucket_indices(times, max_points)
+
+    pre = bucket_indices(times, max_points * SIMPLIFY_PREBUCKET_FACTOR)
+    return pre[simplify_indices(latitudes[pre], longitudes[pre], max_points)]